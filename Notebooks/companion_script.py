@@ -114,28 +114,24 @@ def run_sleuth(setup):
 
 ##### Before DiSCoVER
 def split_discover_dataframe(df, min_score=0):
-    # This is super inefficient for larger DataFrames, but let's worry about efficiency later
-
-    out = pd.DataFrame(columns=['moa','GDSC','CTRP','CCLE','drug'])
-
-    for index, row in df.iterrows():
-        dataset = row['drug'].split('_')[0].lower()
-        drug = row['drug'].split('_')[1].lower()
-
-        if dataset == 'gdsc':
-            out.loc[drug,'GDSC'] = row['score']
-        elif dataset == 'ctrp':
-            out.loc[drug,'CTRP'] = row['score']
-        elif dataset == 'ccle':
-            out.loc[drug,'CCLE'] = row['score']
-        out.loc[drug,'drug'] = row['drug']
-        out.loc[drug,'moa'] = row['moa']
-
-    #     df['database'] = [drug.split('_')[0].upper() for drug in df['drug']]
-    #     df['drug'] = [drug.split('_')[1].lower() for drug in df['drug']]
-    #     df = df[df['score']>0]  # It feels inneficient to do this last, but Pandas complaints if I do it earlier.
-    #     out = df[~df['drug'].duplicated(keep='first')].drop('score', axis=1,inplace=False)
-    #     out['Drug'] = np.unique([drug.split('_')[1].lower() for drug in df['drug']])
+    """
+    One row per drug name (lowercase, without the database prefix) and one score column per database,
+    in order of first appearance. For repeated names the last row's drug, moa and per-database score are kept.
+    """
+    parts = df['drug'].str.split('_')
+    long_df = pd.DataFrame({'dataset': parts.str[0].str.lower().values,
+                            'name': parts.str[1].str.lower().values,
+                            'score': df['score'].values,
+                            'drug': df['drug'].values,
+                            'moa': df['moa'].values})
+    names = pd.unique(long_df['name'])
+    last = long_df.drop_duplicates('name', keep='last').set_index('name')
+    out = pd.DataFrame(index=names)
+    out['moa'] = last['moa'].reindex(names).values
+    for dataset, column in [('gdsc', 'GDSC'), ('ctrp', 'CTRP'), ('ccle', 'CCLE')]:
+        scores = long_df[long_df['dataset'] == dataset].drop_duplicates('name', keep='last').set_index('name')['score']
+        out[column] = scores.reindex(names).values.astype(float)
+    out['drug'] = last['drug'].reindex(names).values
     return out
 
 
@@ -155,9 +151,18 @@ def supporting_evidence(row):
     return sign_to_letter[str(np.sign(row[0]))]+sign_to_letter[str(np.sign(row[1]))]+sign_to_letter[str(np.sign(row[2]))]
 
 
+def evidence_letters(scores):
+    # sign_to_letter for a whole column: '+', '-', or '.' for zero and NaN
+    signs = np.sign(np.asarray(scores, dtype=float))
+    return np.where(signs > 0, '+', np.where(signs < 0, '-', '.')).astype(object)
+
+
 def rank_drugs_discover(df):
     df['score'] = df.drop(['moa','drug'],axis=1,inplace=False).mean(axis=1,skipna=True).round(3)
-    df['evidence'] = df.drop(['moa','score'],axis=1).apply(supporting_evidence, axis=1)
+    # supporting_evidence() of the first three columns other than moa and score, for all rows at once
+    evidence_cols = df.drop(['moa','score'],axis=1).columns[:3]
+    df['evidence'] = evidence_letters(df[evidence_cols[0]]) + evidence_letters(df[evidence_cols[1]]) + \
+        evidence_letters(df[evidence_cols[2]])
     return df.sort_values(by=['score'],ascending=False,axis=0)
 
 ###===========================================================================
@@ -168,6 +173,47 @@ def standarize_string(what):
     return re.sub(r'[ _-]', '', ascii_8bit) # remove space, underscore, and dash (" _-")
 
 
+def standarize_strings(what):
+    # standarize_string() for a whole Series
+    ascii_8bit = what.str.replace(r'[^ -~]', '', regex=True).str.lower()
+    return ascii_8bit.str.replace(r'[ _-]', '', regex=True)
+
+
+cellosaurus_dir = '/build/drug_suggestion/expression/discover/cellosaurus'
+cellosaurus_tables = {}  # pickle file: DataFrame with one row per key, unpickled once per session
+
+
+def load_cellosaurus_table(pickle_file):
+    """
+    A cellosaurus dictionary ({key: {'Names': ..., 'Disease': ..., 'CellosaurusID': ...}}) as a DataFrame indexed by key
+    """
+    if pickle_file not in cellosaurus_tables:
+        with open(pickle_file, 'rb') as f:
+            dic = pickle.load(f)
+        cellosaurus_tables[pickle_file] = pd.DataFrame.from_dict(dic, orient='index')
+    return cellosaurus_tables[pickle_file]
+
+
+def add_cellosaurus_info(df, table, keys, columns, missing=None):
+    """
+    Set columns of df from the rows of table matching keys (one per row of df).
+    :param missing: dict of column to values (scalar or one per row) for keys not in table;
+        if None, unmatched rows keep their previous values (NaN for new columns)
+    :return: int, number of keys not in table
+    """
+    found = pd.Index(keys).isin(table.index)
+    info = table.reindex(keys)
+    for column in columns:
+        if missing is not None:
+            other = missing[column]
+        elif column in df.columns:
+            other = df[column].values
+        else:
+            other = np.nan
+        df[column] = info[column].where(found, other).values
+    return (~found).sum()
+
+
 # the name of the enrichment is the same as the patient ID which is stored in setup.case_id
 def add_rank(df,by,name):
     df = df.sort_values(ascending=False, by=by)
@@ -177,88 +223,45 @@ def add_rank(df,by,name):
 
 # Take each disease and assign it a rank
 def rank_diseases(df):
+    # one row per disease in the '__&&__'-separated Disease column of each cell line
     rank_name = df.columns[-1]
-    new_df = pd.DataFrame()
-    to_add = pd.Series()
-    new_ix = 0
-    for ix,row in df.loc[:,['Disease',rank_name]].iterrows():
-        for disease in row['Disease'].split('__&&__'):
-            to_add['Disease'] = disease
-            to_add[rank_name] = row[rank_name]
-            to_add.name = new_ix
-            new_df = new_df.append(to_add)
-#             print(to_add)
-            new_ix += 1
+    new_df = pd.DataFrame({'Disease': df['Disease'].str.split('__&&__').values,
+                           rank_name: df[rank_name].values}).explode('Disease')
+    new_df.index = range(len(new_df))
     return new_df
 
 
 def average_disease_rank(df,rank_name):
-    new_df = pd.DataFrame()
-    for disease in np.unique(df['Disease']):
-        new_df.loc[disease.lower(),'mean_rank'] = df[df['Disease']==disease].loc[:,rank_name].median()
-        new_df.loc[disease.lower(),'weight'] = len(df[df['Disease']==disease].loc[:,rank_name])
+    ranks = df.groupby('Disease')[rank_name]
+    new_df = pd.DataFrame({'mean_rank': ranks.median(), 'weight': ranks.size().astype(float)})
+    new_df.index = [disease.lower() for disease in new_df.index]
+    new_df = new_df[~new_df.index.duplicated(keep='last')]
     return new_df.sort_values(by='mean_rank')
 
 
 def rank_cell_lines(setup):
     # first load some dictionaries -- this load assumes container edjuaro/pdx-hts:3.0 or later
-    cid2dic = pickle.load(file=open('/build/drug_suggestion/expression/discover/cellosaurus/cellosaurus_cosmic_id_dic.p','rb'))
-    name2dic = pickle.load(file=open('/build/drug_suggestion/expression/discover/cellosaurus/cellosaurus_name_dic.p','rb'))
-
-    # CCLE
-    ccle = pd.read_csv(os.path.join(setup.discover_out_dir,"cell_lines_IDs_and_types_ccle.csv"),index_col=0)
-    missing = 0
-    for ix, row in ccle.iterrows():
-        name = standarize_string(ix)
-        try:
-            dic = name2dic[name]
-        except KeyError:
-            missing += 1
-            dic = {}
-            dic['Names'] = ix
-            dic['Disease'] = 'N/A'
-            dic['CellosaurusID'] = 'N/A'
-        ccle.loc[ix,'Names'] = dic['Names']
-        ccle.loc[ix,'CellosaurusID'] = dic['CellosaurusID']
-        ccle.at[ix,'Disease'] = dic['Disease']
-    if missing >0:
-        log(f'CCLE is missing {missing} cell lines (out of {len(ccle)})')
-    ccle.to_excel(os.path.join(setup.discover_out_dir,"processed_cell_lines_info_ccle.xlsx"))
-    # ccle.head()
-
-    #CTRP
-    ctrp = pd.read_csv(os.path.join(setup.discover_out_dir,"cell_lines_IDs_and_types_ctrp.csv"),index_col=0)
-    missing = 0
-    for ix, row in ctrp.iterrows():
-        name = standarize_string(ix)
-        try:
-            dic = name2dic[name]
-        except KeyError:
-            missing += 1
-            dic = {}
-            dic['Names'] = ix
-            dic['Disease'] = 'N/A'
-            dic['CellosaurusID'] = 'N/A'
-        ctrp.loc[ix,'Names'] = dic['Names']
-        ctrp.loc[ix,'CellosaurusID'] = dic['CellosaurusID']
-        ctrp.at[ix,'Disease'] = dic['Disease']
-    if missing >0:
-        log(f'CTRP is missing {missing} cell lines (out of {len(ctrp)})')
-    ctrp.to_excel(os.path.join(setup.discover_out_dir,"processed_cell_lines_info_ctrp.xlsx"))
-    # ctrp.head()
-
-    # GDSC
+    cid_table = load_cellosaurus_table(os.path.join(cellosaurus_dir, 'cellosaurus_cosmic_id_dic.p'))
+    name_table = load_cellosaurus_table(os.path.join(cellosaurus_dir, 'cellosaurus_name_dic.p'))
+
+    # CCLE and CTRP, by standardized cell line name
+    for cl in ['ccle', 'ctrp']:
+        df = pd.read_csv(os.path.join(setup.discover_out_dir,"cell_lines_IDs_and_types_{}.csv".format(cl)),index_col=0)
+        names = standarize_strings(pd.Series(df.index, dtype=str)).values
+        missing = add_cellosaurus_info(df, name_table, names, ['Names', 'CellosaurusID', 'Disease'],
+                                       missing={'Names': df.index.values, 'CellosaurusID': 'N/A', 'Disease': 'N/A'})
+        if missing >0:
+            log(f'{cl.upper()} is missing {missing} cell lines (out of {len(df)})')
+        df.to_excel(os.path.join(setup.discover_out_dir,"processed_cell_lines_info_{}.xlsx".format(cl)))
+        if cl == 'ccle':
+            ccle = df
+        else:
+            ctrp = df
+
+    # GDSC, by COSMIC ID
     gdsc = pd.read_csv(os.path.join(setup.discover_out_dir,"cell_lines_IDs_and_types_COSMIC_IDS_gdsc.csv"),index_col=0)
-    missing = 0
-    for ix, row in gdsc.iterrows():
-        cid = str(int(row['COSMIC ID']))
-        try:
-            dic = cid2dic[cid]
-            gdsc.loc[ix,'Names'] = dic['Names']
-            gdsc.at[ix,'Disease'] = dic['Disease']
-            gdsc.loc[ix,'CellosaurusID'] = dic['CellosaurusID']
-        except KeyError:
-            missing+=1
+    cids = gdsc['COSMIC ID'].astype(int).astype(str).values
+    missing = add_cellosaurus_info(gdsc, cid_table, cids, ['Names', 'Disease', 'CellosaurusID'])
     if missing>0:
         log(f"GDSC is missing {missing} cell lines (out of {len(gdsc)}). That's a bit troubling")
     gdsc.to_excel(os.path.join(setup.discover_out_dir,"processed_cell_lines_info_gdsc.xlsx"))
@@ -275,8 +278,10 @@ def rank_cell_lines(setup):
     gdsc_rank = rank_diseases(df=gdsc)
 
     #Merge the three databases
-    merged = ccle_rank.rename({"CCLE_rank": "rank"}, axis='columns').append(ctrp_rank.rename({"CTRP_rank": "rank"}, axis='columns')).append(gdsc_rank.rename({"GDSC_rank": "rank"}, axis='columns'))
-    merged['Disease'] = merged.apply(lambda x: x['Disease'].lower(), axis=1)
+    merged = pd.concat([ccle_rank.rename({"CCLE_rank": "rank"}, axis='columns'),
+                        ctrp_rank.rename({"CTRP_rank": "rank"}, axis='columns'),
+                        gdsc_rank.rename({"GDSC_rank": "rank"}, axis='columns')])
+    merged['Disease'] = merged['Disease'].str.lower()
 
     # Only the merged rank will be printed for now
     # ccle_average_rank = average_disease_rank(df=ccle_rank,rank_name='CCLE_rank')
@@ -302,30 +307,40 @@ from drug_suggestion.expression.controls import load_control_exp
 
 #### Before merge
 def add_cmap_to_split_df(discover,cmap):
+    """
+    Add CMap scores (long format: drug, score, moa) to the output of rank_drugs_discover(), matching
+    lowercase drug names. Repeated CMap drugs are folded in order as before: each score is averaged with
+    the running value (skipping NaNs), and each adds its sign to the evidence; drugs without CMap scores
+    get '.'. CMap drugs not in DiSCoVER are appended, in order of first appearance, with the CMap MoA.
+    """
     df = discover.rename(index=str, columns={"score": "DiSCoVER", "moa":"MoA"},inplace=False)
-    for index, row in cmap.iterrows():
-        drug = row['drug'].lower()
-        try:
-            if str(df.loc[drug,'CMAP']) != 'nan':
-                #drug already exists and a CMAP score has been added
-                df.loc[drug,'CMAP'] = np.nanmean([row['score'], df.loc[drug,'CMAP']])
-            else:
-                # drug already exists but a CMAP score has not been added
-                df.loc[drug,'CMAP'] = row['score']
-        except KeyError:
-            # drug didn't exist therefore a CMAP score had not been added
-            df.loc[drug,'CMAP'] = row['score']
-            df.loc[drug,'MoA'] = row['moa']
-        if str(df.loc[drug,'evidence'])=='nan': #numpy is not letting me use np.isnan()
-            df.loc[drug,'evidence'] = '...'+sign_to_letter[str(np.sign(row['score']))]
-        else:
-            df.loc[drug,'evidence'] = str(df.loc[drug,'evidence'])+sign_to_letter[str(np.sign(row['score']))]
-
-    #update those rows which are not in cmap
-    for index, row in df.iterrows():
-        if len(row['evidence'])==3:
-            df.loc[index,'evidence']  = df.loc[index,'evidence']+'.'
-
+    names = cmap['drug'].str.lower().values
+    scores = cmap['score'].values.astype(float)
+    letters = evidence_letters(scores)
+    codes, uniques = pd.factorize(names)
+    uniques = pd.Index(uniques)
+    # position of each row among the rows of the same drug
+    order = np.argsort(codes, kind='stable')
+    group_starts = np.r_[0, np.flatnonzero(np.diff(codes[order])) + 1]
+    occurrence = np.empty(len(codes), dtype=int)
+    occurrence[order] = np.arange(len(codes)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(codes)]))
+    cmap_scores = np.full(len(uniques), np.nan)
+    cmap_evidence = np.full(len(uniques), '', dtype=object)
+    for i in range(occurrence.max() + 1 if len(codes) else 0):
+        rows = occurrence == i
+        group = codes[rows]
+        current, new = cmap_scores[group], scores[rows]
+        with np.errstate(invalid='ignore'):
+            cmap_scores[group] = np.where(np.isnan(current), new, np.where(np.isnan(new), current, (new + current) / 2))
+        cmap_evidence[group] = cmap_evidence[group] + letters[rows]
+    cmap_evidence = pd.Series(cmap_evidence, index=uniques)
+    df['evidence'] = df['evidence'] + cmap_evidence.reindex(df.index).fillna('.').values
+    new_drugs = ~uniques.isin(df.index)
+    first_moas = cmap['moa'].values[order[group_starts]] if len(codes) else np.array([])
+    new_rows = pd.DataFrame({'MoA': first_moas[new_drugs], 'evidence': '...' + cmap_evidence[new_drugs].values},
+                            index=uniques[new_drugs])
+    df = pd.concat([df, new_rows])
+    df['CMAP'] = pd.Series(cmap_scores, index=uniques).reindex(df.index).values
     return df[['drug','MoA','GDSC','CTRP','CCLE','DiSCoVER','CMAP','evidence']]
 
 def rank_combined_df(df):
@@ -342,53 +357,14 @@ def rank_combined_df(df):
     return df.drop(['GDSC','CTRP','CCLE'],axis=1,inplace=False)
 
 ## For discover
-from collections import defaultdict
-import utils
+from modules.drug_index import load_drug_index
 drug_annotation_dir = os.path.dirname('/build/drug_suggestion/drug_annotation/')
 sys.path.append(os.path.join(drug_annotation_dir))
 
 
-def load_reasonable_drugs():
-    reasonable_drugs_file = os.path.join(drug_annotation_dir, 'clinically_relevant_drugs.csv')
-    with open(reasonable_drugs_file, 'r') as f:
-        rdrugs = [row.strip() for row in f.readlines()]
-    return rdrugs
-
-
-reasonable_drugs = load_reasonable_drugs()
-
-
-def select_reasonable_drugs(other_drug_to_cids, rdrug_to_cids):
-    reasonable_cids = utils.all_unique_dict_values(rdrug_to_cids)
-    cid_to_other_drugs = defaultdict(set)
-    for other_drug, cids in other_drug_to_cids.items():
-        for cid in cids:
-            cid_to_other_drugs[cid].add(other_drug)
-    reasonable_other_drugs = set()
-    for cid, other_drugs in cid_to_other_drugs.items():
-        if cid in reasonable_cids:
-            reasonable_other_drugs.update(other_drugs)
-    return reasonable_other_drugs
-
-
 def format_drugs(ranked_drugs, drug2cids, annot=False, out_prefix=None, out_dir=None):
-    robfile = os.path.join(drug_annotation_dir, 'drug_source_moa_annotations.xlsx')
-    robdf = pd.read_excel(robfile, index_col=0, dtype=str)
-
-    rdrug_to_cids = {}
-    hascid = robdf.cids.dropna()
-    for drug in hascid.index:
-        if drug in reasonable_drugs:
-            cids = robdf.loc[drug, 'cids'].split('|')
-            if cids != ['nan']:
-                rdrug_to_cids[drug] = list(map(int, cids))
-
-    reasonable_other_drugs = select_reasonable_drugs(drug2cids, rdrug_to_cids)
-
-    cid_to_rdrug = {}
-    for rdrug, cids in rdrug_to_cids.items():
-        for cid in cids:
-            cid_to_rdrug[cid] = rdrug
+    # built once from drug_source_moa_annotations.xlsx and reused for every sample
+    drug_index = load_drug_index(drug_annotation_dir)
 
     #print([d for d in reasonable_other_drugs if d not in ranked_drugs.columns])
 
@@ -396,28 +372,8 @@ def format_drugs(ranked_drugs, drug2cids, annot=False, out_prefix=None, out_dir=
     # reasonable_results = ranked_drugs.loc[:, reasonable_other_drugs].T
     reasonable_results = ranked_drugs.T
 
-    rdrug_mechs = pd.read_excel(robfile, index_col=0, sheetname='NCI +', dtype=str).iloc[:, 7].dropna()
-    rdrug_mechs.index = [str(idx).lower() for idx in rdrug_mechs.index]
-
-    rr_mechs = pd.Series(index=reasonable_results.index)
-    # counter1 = 0
-    # counter2 = 0
-    for drug in rr_mechs.index:
-        try:
-            cids = drug2cids[drug]
-            # counter1 += 1
-        except KeyError:
-            cids = 'Not Clinically Relevant'
-            # counter2 += 1
-        for cid in cids:
-            if cid in cid_to_rdrug:
-                rdrug = cid_to_rdrug[cid]
-                if rdrug in rdrug_mechs:
-                    rr_mechs[drug] = rdrug_mechs.loc[rdrug]
-                else:
-                    rr_mechs[drug] = ''
-            else:
-                rr_mechs[drug] = 'Not Clinically Relevant'
+    rr_mechs = drug_index.annotate_moa(reasonable_results.index, drug2cids, any_cid=False,
+                                       unmatched='Not Clinically Relevant')
     # print(counter1,counter2)
     if annot:
         reasonable_results['moa'] = rr_mechs
@@ -8,20 +8,31 @@ The author also shared code for Chib's method and ICM algorithm via email
 The author indicated that what they refer to as a "rectified" gaussian is actually a truncated gaussian.
 """
 import os
+import sys
+import json
 import time
 import math
+import shutil
+import tempfile
 
+import joblib
 import numpy as np
+import pandas as pd
 import scipy.stats
-from scipy.special import erfc, erfcinv
+from scipy.special import erfc, erfcinv, log_ndtr
 from sklearn.decomposition import NMF
 from sklearn.utils.validation import check_array, check_is_fitted
 from sklearn.metrics import mean_squared_error
 from joblib import Parallel, delayed
 
-math_log = np.vectorize(math.log)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from modules.results_store import hash_inputs
+
 MACHINE_PREC = np.finfo(float).eps
 LOG_ZERO = math.log(MACHINE_PREC)
+supported_backends = 'loky multiprocessing threading'.split()
+sweep_marginal_likelihoods = ['best', 'all', None]
 
 
 class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
@@ -60,6 +71,19 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
         Store only mean of parameters, rather than samples.
          To save memory when using mode='gibbs'.
 
+    thin : int, default: 1
+        With mean_only=False, store every thin-th Gibbs sample.
+        Posterior means and variances are still computed from every sample after burn-in.
+
+    keep_burnin : bool, default: True
+        With mean_only=False, whether to store burn-in samples as well.
+
+    samples_dir : str or None, default: None
+        With mean_only=False, directory to write samples to, as memory-mapped .npy files
+        (e.g. bases_samples.npy) that can be reopened with np.load(path, mmap_mode='r').
+        Each fit writes to a new subdirectory of it, recorded in samples_path_, so fits sharing
+        samples_dir don't overwrite each other's samples. If None, samples are kept in memory.
+
     random_state : int, RandomState instance or None, optional, default: None
         If int, random_state is the seed used by the random number generator;
         If RandomState instance, random_state is the random number generator;
@@ -77,6 +101,9 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
     bases_ : array, [n_samples, n_components]
         W matrix
 
+    bases_posterior_variance_, components_posterior_variance_, variance_posterior_variance_ : arrays
+        Variances of the Gibbs samples after burn-in (mode='gibbs' and mean_only=False)
+
     reconstruction_err_ : number
         Frobenius norm of the matrix difference, or beta-divergence, between
         the training data ``X`` and the reconstructed data ``WH`` from
@@ -106,7 +133,10 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
                  burnin_fraction=0.5,
                  mean_only=True,
                  random_state=None,
-                 verbose=False):
+                 verbose=False,
+                 thin=1,
+                 keep_burnin=True,
+                 samples_dir=None):
 
         if mode not in ['icm', 'gibbs']:
             raise ValueError("{} is not a supported mode. Try 'icm' or 'gibbs'".format(mode))
@@ -117,6 +147,11 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
         self.tol = tol
         self.burnin_fraction = burnin_fraction
         self.mean_only = mean_only
+        if thin < 1:
+            raise ValueError("thin must be at least 1, not {}".format(thin))
+        self.thin = thin
+        self.keep_burnin = keep_burnin
+        self.samples_dir = samples_dir
         if isinstance(random_state, np.random.RandomState):
             self.random_state = random_state
         else:
@@ -132,6 +167,10 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
         self.bases_samples_ = None
         self.components_samples_ = None
         self.variance_samples_ = None
+        self.samples_path_ = None
+        self.bases_posterior_variance_ = None
+        self.components_posterior_variance_ = None
+        self.variance_posterior_variance_ = None
         self.bases_ = None
         self.components_ = None
         self.variance_ = None
@@ -140,6 +179,9 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
         self.last_sampled_components_ = None
         self.last_sampled_variance_ = None
         self.n_free_params_ = None
+        self.n_iter_ = None
+        self.marginal_likelihood_blocks_ = None
+        self.marginal_likelihood_se_ = None
         self.input_shape_ = None
 
     def fit(self, X, y=None,
@@ -151,7 +193,8 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
             components_init=None,
             variance_init=None,
             alpha_prior_scalar=None,
-            beta_prior_scalar=None):
+            beta_prior_scalar=None,
+            check_every=1):
         """Learn a Bayesian NMF model for the data X.
 
         Parameters
@@ -161,6 +204,11 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
 
         y : ignored
 
+        check_every : int, default: 1
+            ICM only: compute the reconstruction error every check_every iterations,
+            and stop when it decreased by no more than tol per iteration since the last check.
+            With 1, the result does not depend on it.
+
         Returns
         -------
         self : object
@@ -200,14 +248,30 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
         A_mean = np.zeros(A.shape)
         B_mean = np.zeros(B.shape)
         mu2_mean = 0
-        As = []
-        Bs = []
-        mu2s = []
+        store_samples = self.mode == 'gibbs' and not self.mean_only
+        if store_samples:
+            self.samples_path_ = None
+            if self.samples_dir is not None:
+                if not os.path.exists(self.samples_dir):
+                    os.makedirs(self.samples_dir)
+                self.samples_path_ = tempfile.mkdtemp(prefix='bnmf_samples_', dir=self.samples_dir)
+            sample_shapes = [('bases', A.shape), ('components', B.shape), ('variance', ())]
+            n_burnin_stored = len(range(0, burnin_index, self.thin))
+            burnin_stores = [self.sample_store('burnin_{}_samples'.format(name), shape, n_burnin_stored)
+                             for name, shape in sample_shapes] if self.keep_burnin else []
+            stores = [self.sample_store('{}_samples'.format(name), shape, len(range(burnin_index, M, self.thin)))
+                      for name, shape in sample_shapes]
+            moments = [RunningMoments(shape) for _, shape in sample_shapes]
         chi = 0.5 * np.square(X).sum()
         mu2 = np.var(X - np.dot(A, B)) if variance_init is None else variance_init
         m = 0
         diff = self.tol + 1
-        obj = mean_squared_error(X, np.dot(A, B))
+        gibbs = self.mode == 'gibbs'
+        notns = [np.r_[0:n, n + 1:N] for n in range(N)]  # the other components of each n
+        bases_cols = [n for n in range(N) if bases_cols_to_sample[n]]
+        components_rows = [n for n in range(N) if components_rows_to_sample[n]]
+        X_buffer = None if gibbs else np.empty(X.shape)
+        obj = reconstruction_mse(X, A, B, out=X_buffer)
         t = time.time()
         while m < M and diff > self.tol:
             if print_every is not None:
@@ -222,54 +286,62 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
                     print("iter {}{}".format(m + 1, timestring))
             C = np.dot(B, B.T)
             D = np.dot(X, B.T)
-            for n in range(N):
-                if bases_cols_to_sample[n]:
-                    notn = list(range(n)) + list(range(n + 1, N))
-                    an = (D[:, n] - np.dot(A[:, notn], C[notn, n]) - alpha[:, n] * mu2) / (C[n, n] + MACHINE_PREC)
-                    if self.mode == 'gibbs':
-                        rnorm_variance = mu2 / (C[n, n] + MACHINE_PREC)
-                        A[:, n] = truncated_normal_sample(an, rnorm_variance, alpha[:, n],
-                                                          random_state=self.random_state)
-                    else:
-                        A[:, n] = an.clip(min=0)
+            if gibbs:
+                # each column's mean depends on the columns drawn before it, so only the random numbers
+                # of a factor can be drawn at once; they are the same as with one draw per column
+                uniforms = self.random_state.random_sample((len(bases_cols), I))
+            for i, n in enumerate(bases_cols):
+                # a fancy-indexed copy; np.take(..., out=) into a buffer of the same (Fortran) layout is far slower
+                an = (D[:, n] - np.dot(A[:, notns[n]], C[notns[n], n]) - alpha[:, n] * mu2) / (C[n, n] + MACHINE_PREC)
+                if gibbs:
+                    rnorm_variance = mu2 / (C[n, n] + MACHINE_PREC)
+                    A[:, n] = truncated_normal_sample(an, rnorm_variance, alpha[:, n], y=uniforms[i])
+                else:
+                    A[:, n] = an.clip(min=0)
             ac_2d_diff = np.dot(A, C) - (2 * D)
             xi = 0.5 * np.multiply(A, ac_2d_diff).sum()
             if sample_sigma:
-                if self.mode == 'gibbs':
+                if gibbs:
                     mu2 = scipy.stats.invgamma.rvs(a=(I * J / 2) + k + 1, scale=chi + theta + xi,
                                                    random_state=self.random_state)
                 else:
                     mu2 = (theta + chi + xi) / ((I * J / 2) + k + 1)
             E = np.dot(A.T, A)
             F = np.dot(A.T, X)
-            for n in range(N):
-                if components_rows_to_sample[n]:
-                    notn = list(range(n)) + list(range(n + 1, N))
-                    bn = (F[n] - np.dot(E[n, notn], B[notn]) - beta[n] * mu2) / (E[n, n] + MACHINE_PREC)
-                    if self.mode == 'gibbs':
-                        rnorm_variance = mu2 / (E[n, n] + MACHINE_PREC)
-                        B[n] = truncated_normal_sample(bn, rnorm_variance, beta[n], random_state=self.random_state)
-                    else:
-                        B[n] = bn.clip(min=0)
-            if self.mode == 'gibbs':
+            if gibbs:
+                uniforms = self.random_state.random_sample((len(components_rows), J))
+            for i, n in enumerate(components_rows):
+                bn = (F[n] - np.dot(E[n, notns[n]], B[notns[n]]) - beta[n] * mu2) / (E[n, n] + MACHINE_PREC)
+                if gibbs:
+                    rnorm_variance = mu2 / (E[n, n] + MACHINE_PREC)
+                    B[n] = truncated_normal_sample(bn, rnorm_variance, beta[n], y=uniforms[i])
+                else:
+                    B[n] = bn.clip(min=0)
+            if gibbs:
                 if self.mean_only:
                     if m >= burnin_index:
                         A_mean += A / n_after_burnin
                         B_mean += B / n_after_burnin
                         mu2_mean += mu2 / n_after_burnin
-                else:
-                    As.append(A.copy())
-                    Bs.append(B.copy())
-                    mu2s.append(mu2)
-            else:
-                new_obj = mean_squared_error(X, np.dot(A, B))
-                diff = obj - new_obj
+                elif m >= burnin_index:
+                    for moment, store, x in zip(moments, stores, [A, B, mu2]):
+                        moment.update(x)
+                        if (m - burnin_index) % self.thin == 0:
+                            store.append(x)
+                elif self.keep_burnin and m % self.thin == 0:
+                    for store, x in zip(burnin_stores, [A, B, mu2]):
+                        store.append(x)
+            elif (m + 1) % check_every == 0:
+                new_obj = reconstruction_mse(X, A, B, out=X_buffer)
+                diff = (obj - new_obj) / check_every if check_every > 1 else obj - new_obj
                 obj = new_obj
                 if self.verbose:
                     print("MSE: ", obj)
             m += 1
         if self.mode == 'gibbs':
-            As, Bs, mu2s = [np.array(arr) for arr in [As, Bs, mu2s]]
+            if store_samples:
+                A_mean, B_mean = moments[0].mean, moments[1].mean
+                mu2_mean = float(moments[2].mean)
             self.A_mean = A_mean
             self.B_mean = B_mean
             self.mu2_mean = mu2_mean
@@ -281,23 +353,32 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
                 B = B_mean
                 mu2 = mu2_mean
             else:
-                self.burnin_bases_samples_ = As[:burnin_index]
-                self.burnin_components_samples_ = Bs[:burnin_index]
-                self.burnin_variance_samples_ = mu2s[:burnin_index]
-                self.bases_samples_ = As[burnin_index:]
-                self.components_samples_ = Bs[burnin_index:]
-                self.variance_samples_ = mu2s[burnin_index:]
-                A = self.bases_samples_.mean(axis=0)
-                B = self.components_samples_.mean(axis=0)
-                mu2 = self.variance_samples_.mean(axis=0)
+                for store in burnin_stores + stores:
+                    store.flush()
+                if self.keep_burnin:
+                    self.burnin_bases_samples_, self.burnin_components_samples_, self.burnin_variance_samples_ = \
+                        [store.samples for store in burnin_stores]
+                self.bases_samples_, self.components_samples_, self.variance_samples_ = \
+                    [store.samples for store in stores]
+                self.bases_posterior_variance_ = moments[0].variance
+                self.components_posterior_variance_ = moments[1].variance
+                self.variance_posterior_variance_ = float(moments[2].variance)
+                A = A_mean
+                B = B_mean
+                mu2 = mu2_mean
         obj = mean_squared_error(X, np.dot(A, B))
         self.bases_ = A
         self.components_ = B
         self.variance_ = mu2
         self.reconstruction_err_ = obj
+        self.n_iter_ = m
         self.n_free_params_ = np.count_nonzero(self.bases_) + np.count_nonzero(self.components_) + 1
         return self
 
+    def sample_store(self, name, shape, n_samples):
+        path = None if self.samples_path_ is None else os.path.join(self.samples_path_, '{}.npy'.format(name))
+        return SampleStore(shape, n_samples, path=path)
+
     def fit_transform(self, X, y=None, **fit_params):
         """Learn a NMF model for the data X and returns the transformed data.
 
@@ -339,13 +420,28 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
             raise ValueError('Shape of input is different from what was seen'
                              'in `fit`')
 
-    def marginal_likelihood(self, X, max_iter=1000, burnin_fraction=0.5, n_jobs=1):
+    def marginal_likelihood(self, X, max_iter=1000, burnin_fraction=0.5, n_jobs=1, backend='loky', random_state=None,
+                            checkpoint_file=None, verbose=False):
+        """
+        Log marginal likelihood of X by Chib's method, from one Gibbs chain per parameter block
+        (the columns of A, then the rows of B), run in parallel. X is memory-mapped rather than pickled
+        per block, and each chain has its own random stream, spawned with np.random.SeedSequence.
+        The estimate of each block is kept in marginal_likelihood_blocks_, with its Monte Carlo standard error;
+        marginal_likelihood_se_ is the standard error of the result.
+        :param backend: joblib backend, one of 'loky', 'multiprocessing' or 'threading'
+        :param random_state: int, entropy of the chains' seeds; if None, it is drawn from self.random_state
+        :param checkpoint_file: str, optional JSON file. Block estimates are saved to it as they complete,
+            and a later call for the same model and arguments only runs the missing blocks.
+        :param verbose: bool, whether to print each block's estimate as it completes
+        :return: float
+        """
+        if backend not in supported_backends:
+            raise ValueError('{} not a supported backend; try one of {}'.format(backend, supported_backends))
         X = check_array(X)
         check_is_fitted(self, ['input_shape_'])
         self.check_input_shape(X)
         # Should burn-in not be necessary for this? If starting from the equilibrium distribution...
         # todo: check Schmidt code for this.
-        rs = self.random_state
         M = max_iter
         A, B, mu2, alpha, beta, k, theta = [self.bases_,
                                             self.components_,
@@ -356,7 +452,7 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
                                             self.variance_prior_scale_]
         N = self.n_components
         X_model = np.dot(A, B)
-        log_p_x_g_theta = scipy.stats.norm.logpdf(X, loc=X_model, scale=mu2).sum()
+        log_p_x_g_theta = scipy.stats.norm.logpdf(X, loc=X_model, scale=np.sqrt(mu2)).sum()
         log_p_a = scipy.stats.expon.logpdf(A,
                                            scale=1 / alpha).sum()  # if expon were param'd with rate lambda, it would not be inverse
         log_p_b = scipy.stats.expon.logpdf(B, scale=1 / beta).sum()
@@ -372,113 +468,353 @@ class BayesianNMF(NMF):  # BaseEstimator, TransformerMixin
         # mean over gibbs samples of
         # p(tk | t1, t2, ... tk-1, tk+1(sampled), ...tK(sampled), X)
         chi = 0.5 * np.square(X).sum()
-        gibbs_param_inputs = [(param_block_idx, X, A, B, alpha, beta, mu2, chi, k, theta, M, burnin_fraction, rs) for
-                              param_block_idx in range(2 * N)]
         if n_jobs == -1:
             n_jobs = os.cpu_count()
-        param_prob_means = Parallel(n_jobs=n_jobs)(delayed(gibbs_sample_param_block)(inputs) for inputs in gibbs_param_inputs)
-        log_denom = np.array(param_prob_means).sum()
-        return log_numerator - log_denom
-
-
-def gibbs_sample_param_block(inputs):
-    # In Python3.x multiprocessing can pickle instance methods,
-    # so I could include this in the NMF object
-    # so I don't have to pass around so many parameters
-    # but for Python2 compatibility, it can't be an instance method.
-    # I could pass the NMF object, however.
-    # However, this may prevent joblib from mem-mapping the arrays (if bound to NMF object)
-    pbidx, X, A, B, alpha, beta, mu2, chi, k, theta, M, burnin_fraction, rs = inputs
+        if random_state is not None:
+            random_state = int(random_state)  # NumPy integers are neither stable under repr() nor JSON serializable
+        key = hash_inputs(X, A, B, alpha, beta, np.array([mu2, k, theta]), X.shape, M, burnin_fraction, random_state)
+        checkpoint = {'key': key, 'entropy': None, 'blocks': {}}
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            with open(checkpoint_file, 'r') as f:
+                saved = json.load(f)
+            if saved.get('key') == key:
+                checkpoint = saved
+        if checkpoint['entropy'] is None:
+            checkpoint['entropy'] = int(self.random_state.randint(np.iinfo(np.int32).max)) if random_state is None \
+                else random_state
+        seeds = np.random.SeedSequence(checkpoint['entropy']).spawn(2 * N)
+        remaining = [block for block in range(2 * N) if str(block) not in checkpoint['blocks']]
+        temp_dir = None
+        if remaining and backend != 'threading':
+            temp_dir = tempfile.mkdtemp(prefix='bnmf_chib_')
+            joblib.dump(X, os.path.join(temp_dir, 'X.mmap'))
+            X = joblib.load(os.path.join(temp_dir, 'X.mmap'), mmap_mode='r')
+        try:
+            with Parallel(n_jobs=n_jobs, backend=backend) as parallel:
+                for wave_start in range(0, len(remaining), n_jobs):
+                    wave = remaining[wave_start:wave_start + n_jobs]
+                    estimates = parallel(delayed(gibbs_sample_param_block)(block, X, A, B, alpha, beta, mu2, chi, k,
+                                                                           theta, M, burnin_fraction, seeds[block])
+                                         for block in wave)
+                    for block, (log_prob, standard_error) in zip(wave, estimates):
+                        checkpoint['blocks'][str(block)] = {'log_prob': log_prob, 'standard_error': standard_error}
+                        if verbose:
+                            print('block {}/{}: {:.6g} +/- {:.3g}'.format(block + 1, 2 * N, log_prob, standard_error))
+                    if checkpoint_file is not None:
+                        write_checkpoint(checkpoint, checkpoint_file)
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        blocks = pd.DataFrame([checkpoint['blocks'][str(block)] for block in range(2 * N)])
+        blocks.insert(0, 'factor', ['bases'] * N + ['components'] * N)
+        blocks.insert(1, 'component', list(range(N)) * 2)
+        self.marginal_likelihood_blocks_ = blocks
+        self.marginal_likelihood_se_ = float(np.sqrt(np.square(blocks['standard_error']).sum()))
+        return log_numerator - blocks['log_prob'].sum()
+
+
+def write_checkpoint(checkpoint, checkpoint_file):
+    # written next to the checkpoint and renamed, so an interrupted write leaves the previous one intact
+    temp_file = '{}.tmp'.format(checkpoint_file)
+    with open(temp_file, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_file, checkpoint_file)
+
+
+class SampleStore(object):
+    """
+    Preallocated storage for the Gibbs samples of one parameter, in memory or in a memory-mapped .npy file.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of one sample, () for scalars.
+    n_samples : int
+        Number of samples that will be appended.
+    path : str or None
+        .npy file to write the samples to. In memory if None.
+    """
+
+    def __init__(self, shape, n_samples, path=None):
+        shape = (n_samples,) + tuple(shape)
+        if path is None:
+            self.samples = np.empty(shape)
+        else:
+            self.samples = np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=shape)
+        self.n_samples = 0
+
+    def append(self, x):
+        self.samples[self.n_samples] = x
+        self.n_samples += 1
+
+    def flush(self):
+        if isinstance(self.samples, np.memmap):
+            self.samples.flush()
+
+
+class RunningMoments(object):
+    """
+    Mean and variance of a stream of arrays, updated in place with Welford's algorithm.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of each array, () for scalars.
+    """
+
+    def __init__(self, shape=()):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.sum_sq_dev = np.zeros(shape)
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.sum_sq_dev += delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        """
+        Sample variance (ddof=1); NaN for fewer than 2 arrays
+        """
+        if self.n < 2:
+            return np.full(self.mean.shape, np.nan)
+        return self.sum_sq_dev / (self.n - 1)
+
+
+def sweep_n_components(X, n_components_range, n_restarts=20, max_iter=10000, prune_after=None, n_keep=None,
+                       marginal_likelihood='best', marginal_likelihood_iter=1000, n_jobs=-1, backend='loky',
+                       random_state=None, model_params=None, fit_params=None, verbose=False):
+    """
+    Fit BayesianNMF n_restarts times, from different random initializations, for each number of components,
+    in parallel. X is memory-mapped once rather than pickled per fit, and fitted models are kept on disk
+    until the best one of each rank is loaded.
+    :param X: array-like, (n_samples, n_features)
+    :param n_components_range: iterable of int, e.g. range(2, 13)
+    :param prune_after: int, ICM only. If given, every restart first runs prune_after iterations; then only the
+        n_keep restarts of each rank with the lowest reconstruction error continue to max_iter.
+        Since ICM is deterministic, continued fits end exactly where uninterrupted ones would.
+    :param n_keep: int, defaults to a quarter of n_restarts (at least 1)
+    :param marginal_likelihood: compute BayesianNMF.marginal_likelihood() for the 'best' restart of each rank,
+        'all' restarts, or None
+    :param marginal_likelihood_iter: int, max_iter of marginal_likelihood()
+    :param backend: joblib backend, one of 'loky', 'multiprocessing' or 'threading'
+    :param random_state: int, RandomState instance or None; the seeds of the restarts are drawn from it
+    :param model_params: dict, passed to BayesianNMF(), e.g. {'mode': 'gibbs', 'tol': 1E-8}
+    :param fit_params: dict, passed to BayesianNMF.fit()
+    :return: Pandas DataFrame with one row per fit: n_components, restart, seed, n_iter, pruned,
+        reconstruction_err, aic, bic, marginal_likelihood (NaN where not computed) and best (lowest
+        reconstruction_err of its rank among restarts that were not pruned);
+        BayesianNMF(n_components, random_state=seed) reproduces a fit.
+        dict of n_components to the best fitted BayesianNMF
+    """
+    model_params = {} if model_params is None else dict(model_params)
+    fit_params = {} if fit_params is None else dict(fit_params)
+    if marginal_likelihood not in sweep_marginal_likelihoods:
+        raise ValueError('{} not a supported marginal_likelihood; try one of {}'.format(marginal_likelihood,
+                                                                                       sweep_marginal_likelihoods))
+    if backend not in supported_backends:
+        raise ValueError('{} not a supported backend; try one of {}'.format(backend, supported_backends))
+    if prune_after is not None and model_params.get('mode', 'icm') != 'icm':
+        raise ValueError("Restarts can only be pruned with mode='icm'")
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_keep is None:
+        n_keep = max(1, n_restarts // 4)
+    rs = random_state if isinstance(random_state, np.random.RandomState) else np.random.RandomState(seed=random_state)
+    n_components_range = list(n_components_range)
+    seeds = rs.randint(np.iinfo(np.int32).max, size=(len(n_components_range), n_restarts))
+    fits = pd.DataFrame([{'n_components': n_components, 'restart': restart, 'seed': seeds[i, restart]}
+                         for i, n_components in enumerate(n_components_range) for restart in range(n_restarts)])
+    fits['pruned'] = False
+    first_iter = max_iter if prune_after is None else min(prune_after, max_iter)
+    temp_dir = tempfile.mkdtemp(prefix='bnmf_sweep_')
+    model_files = [os.path.join(temp_dir, '{}_{}.pkl'.format(n_components, restart))
+                   for n_components, restart in zip(fits['n_components'], fits['restart'])]
+    try:
+        joblib.dump(check_array(X), os.path.join(temp_dir, 'X.mmap'))
+        X = joblib.load(os.path.join(temp_dir, 'X.mmap'), mmap_mode='r')
+        with Parallel(n_jobs=n_jobs, backend=backend) as parallel:
+
+            def run_fits(rows, n_iter, init=False):
+                # largest ranks first, so that the slowest fits do not run last
+                rows = sorted(rows, key=lambda row: -fits.at[row, 'n_components'])
+                results = parallel(delayed(fit_sweep_restart)(X, model_files[row], fits.at[row, 'n_components'],
+                                                              fits.at[row, 'seed'], n_iter, model_params, fit_params,
+                                                              init_file=model_files[row] if init else None)
+                                   for row in rows)
+                for row, result in zip(rows, results):
+                    for column, value in result.items():
+                        fits.loc[row, column] = value
+                if verbose:
+                    print('{} fits of up to {} iterations done'.format(len(rows), n_iter))
+
+            run_fits(fits.index, first_iter)
+            if first_iter < max_iter:
+                unconverged = fits['n_iter'] >= first_iter
+                kept = fits.groupby('n_components')['reconstruction_err'].rank(method='first') <= n_keep
+                fits.loc[unconverged & ~kept, 'pruned'] = True
+                run_fits(fits.index[unconverged & kept], max_iter - first_iter, init=True)
+            fits['n_iter'] = fits['n_iter'].astype(int)
+            fits['best'] = False
+            # pruned restarts stopped early, so only those that ran to completion compete
+            completed = fits[~fits['pruned']]
+            fits.loc[completed.groupby('n_components')['reconstruction_err'].idxmin().values, 'best'] = True
+            fits['marginal_likelihood'] = np.nan
+            if marginal_likelihood is not None:
+                rows = fits.index[fits['best']] if marginal_likelihood == 'best' else fits.index
+                fits.loc[rows, 'marginal_likelihood'] = parallel(
+                    delayed(sweep_restart_marginal_likelihood)(X, model_files[row], marginal_likelihood_iter)
+                    for row in rows)
+        best_models = {fits.at[row, 'n_components']: joblib.load(model_files[row]) for row in fits.index[fits['best']]}
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    columns = ['n_components', 'restart', 'seed', 'n_iter', 'pruned', 'reconstruction_err', 'aic', 'bic',
+               'marginal_likelihood', 'best']
+    return fits[columns], best_models
+
+
+def fit_sweep_restart(X, model_file, n_components, seed, max_iter, model_params, fit_params, init_file=None):
+    """
+    One fit of sweep_n_components(); the fitted BayesianNMF is dumped to model_file.
+    :param init_file: model_file of an ICM fit to continue for max_iter more iterations
+    :return: dict of the fit's n_iter, reconstruction_err, aic and bic
+    """
+    n_iter = 0
+    if init_file is not None:
+        init = joblib.load(init_file)
+        n_iter = init.n_iter_
+        # ICM draws nothing once initialized, so the RandomState continues as in an uninterrupted fit
+        seed = init.random_state
+        fit_params = dict(fit_params, bases_init=init.bases_.copy(), components_init=init.components_.copy(),
+                          variance_init=init.variance_)
+    model = BayesianNMF(n_components=n_components, max_iter=max_iter, random_state=seed, **model_params)
+    model.fit(X, **fit_params)
+    model.n_iter_ += n_iter
+    joblib.dump(model, model_file)
+    return {'n_iter': model.n_iter_, 'reconstruction_err': model.reconstruction_err_, 'aic': model.aic(X),
+            'bic': model.bic(X)}
+
+
+def sweep_restart_marginal_likelihood(X, model_file, max_iter):
+    model = joblib.load(model_file)
+    return model.marginal_likelihood(X, max_iter=max_iter)
+
+
+def gibbs_sample_param_block(pbidx, X, A, B, alpha, beta, mu2, chi, k, theta, M, burnin_fraction, seed):
+    """
+    One term of Chib's estimate: the log posterior density of parameter block pbidx (column pbidx of A,
+    or row pbidx - N of B) at its fitted value given the blocks before it, averaged over Gibbs samples
+    of the blocks after it and of the variance.
+    :param seed: np.random.SeedSequence or int, of the chain's random stream
+    :return: float, the log density; float, its Monte Carlo standard error, by the delta method
+        and treating the samples and the entries of the block as independent
+    """
+    rs = np.random.RandomState(np.random.MT19937(seed))
     burnin_index = int(M * burnin_fraction)
     n_after_burnin = M - burnin_index
     I, N = A.shape
     N, J = B.shape
     nB = pbidx - N
+    a_cols = np.arange(min(pbidx + 1, N), N)  # sampled columns of A
+    b_rows = np.arange(max(nB + 1, 0), N)  # sampled rows of B
     An = A.copy()
     Bn = B.copy()
     prob_dim = I if pbidx < N else J
-    prob_mean = np.zeros((prob_dim,))  # 0
+    log_sum = np.full((prob_dim,), -np.inf)
+    log_sum_sq = np.full((prob_dim,), -np.inf)
     for m in range(M):
         C = np.dot(Bn, Bn.T)
         D = np.dot(X, Bn.T)
-        An_temp = An.copy()
-        for n in range(min(pbidx + 1, N), N):
-            notn = list(range(n - 1)) + list(range(n + 1, N))
-            an = (D[:, n] - np.dot(An[:, notn], C[notn, n]) - alpha[:, n] * mu2) / (C[n, n] + MACHINE_PREC)
-            rnorm_variance_a = mu2 / (C[n, n] + MACHINE_PREC)
-            An_temp[:, n] = truncated_normal_sample(an, rnorm_variance_a, alpha[:, n], random_state=rs)
-        An = An_temp
+        C_diag = np.diag(C) + MACHINE_PREC
+        C_offdiag = C - np.diag(np.diag(C))
+        # one column at a time, each given the columns already drawn (as in fit); only the random numbers
+        # of all sampled columns are drawn at once
+        uniforms = rs.random_sample((len(a_cols), I))
+        for i, n in enumerate(a_cols):
+            an = (D[:, n] - np.dot(An, C_offdiag[:, n]) - alpha[:, n] * mu2) / C_diag[n]
+            An[:, n] = truncated_normal_sample(an, mu2 / C_diag[n], alpha[:, n], y=uniforms[i])
         ac_2d_diff = np.dot(An, C) - (2 * D)
         xi = 0.5 * np.multiply(An, ac_2d_diff).sum()
         # Should I be sampling mu2 or just using the fitted value?
         mu2 = scipy.stats.invgamma.rvs(a=(I * J / 2) + k + 1, scale=chi + theta + xi, random_state=rs)
         E = np.dot(An.T, An)
         F = np.dot(An.T, X)
-        Bn_temp = Bn.copy()
-        for n in range(nB + 1, N):
-            notn = list(range(n - 1)) + list(range(n + 1, N))
-            bn = (F[n] - np.dot(E[n, notn], Bn[notn]) - beta[n] * mu2) / (E[n, n] + MACHINE_PREC)
-            rnorm_variance_b = mu2 / (E[n, n] + MACHINE_PREC)
-            Bn_temp[n] = truncated_normal_sample(bn, rnorm_variance_b, beta[n], random_state=rs)
-        Bn = Bn.copy()
+        E_diag = np.diag(E) + MACHINE_PREC
+        E_offdiag = E - np.diag(np.diag(E))
+        uniforms = rs.random_sample((len(b_rows), J))
+        for i, n in enumerate(b_rows):
+            bn = (F[n] - np.dot(E_offdiag[n], Bn) - beta[n] * mu2) / E_diag[n]
+            Bn[n] = truncated_normal_sample(bn, mu2 / E_diag[n], beta[n], y=uniforms[i])
         if pbidx < N:
             C = np.dot(Bn, Bn.T)
             D = np.dot(X, Bn.T)
+            C_offdiag = C - np.diag(np.diag(C))
             x = A[:, pbidx]
-            notn = list(range(pbidx)) + list(range(pbidx + 1, N))
-            param_mean = (D[:, pbidx] -
-                          np.dot(An[:, notn], C[notn, pbidx]) -
-                          alpha[:, pbidx] * mu2) / (C[pbidx, pbidx] + MACHINE_PREC)
+            param_mean = (D[:, pbidx] - np.dot(An, C_offdiag[:, pbidx]) - alpha[:, pbidx] * mu2) / (
+                C[pbidx, pbidx] + MACHINE_PREC)
             param_variance = mu2 / (C[pbidx, pbidx] + MACHINE_PREC)
             param_scale = alpha[:, pbidx]
         else:
-            E = np.dot(An.T, An)
-            F = np.dot(An.T, X)
             x = B[nB]
-            notn = list(range(nB)) + list(range(nB + 1, N))
-            param_mean = (F[nB] - np.dot(E[nB, notn], Bn[notn]) - beta[nB] * mu2) / (
-                E[nB, nB] + MACHINE_PREC)
-            param_variance = mu2 / (E[nB, nB] + MACHINE_PREC)
+            param_mean = (F[nB] - np.dot(E_offdiag[nB], Bn) - beta[nB] * mu2) / E_diag[nB]
+            param_variance = mu2 / E_diag[nB]
             param_scale = beta[nB]
-        prob_sample = truncated_normal_pdf(x, param_mean, param_variance, param_scale, log=True)
+        log_prob = truncated_normal_pdf(x, param_mean, param_variance, param_scale, log=True)
         if m >= burnin_index:
-            prob_mean = log_add(prob_mean, prob_sample - np.log(n_after_burnin))
-    return np.sum(prob_mean)
-
-
-def log_add(X, Y):
-    # Taken from Schmidt's chib.m
-    maxXY = np.max(np.array([X, Y]), axis=0)
-    return maxXY + np.log(np.exp(X - maxXY) + np.exp(Y - maxXY))
+            log_sum = np.logaddexp(log_sum, log_prob)
+            log_sum_sq = np.logaddexp(log_sum_sq, 2 * log_prob)
+    log_means = log_sum - np.log(n_after_burnin)
+    if n_after_burnin < 2:
+        return float(log_means.sum()), np.nan
+    # var(log of mean p) ~= var(p) / (n * mean(p) ** 2); mean((p / mean(p)) ** 2) computed in log space
+    relative_second_moments = np.exp(log_sum_sq + np.log(n_after_burnin) - 2 * log_sum)
+    variances = (relative_second_moments - 1).clip(min=0) / (n_after_burnin - 1)
+    return float(log_means.sum()), float(np.sqrt(variances.sum()))
+
+
+def reconstruction_mse(X, A, B, out=None):
+    """
+    sklearn's mean_squared_error(X, np.dot(A, B)), to the bit, without its input validation.
+    :param out: optional array of the shape of X, used as workspace
+    """
+    out = np.dot(A, B, out=out)
+    np.subtract(X, out, out=out)
+    np.square(out, out=out)
+    return out.mean(axis=0).mean()
 
 
-def truncated_normal_sample(m, s, l, random_state=None):
+def truncated_normal_sample(m, s, l, random_state=None, y=None):
     """
     Return random number from distribution with density
     p(x)=K*exp(-(x-m)^2/s-l'x), x>=0.
-    m and l are vectors and s is scalar
+    m and l are arrays and s is a scalar, or an array broadcasting against them.
+    To draw several columns of A (or rows of B) in one call, pass m and l with one row per column
+    and s with one row each, e.g. of shape (n_columns, 1). The random numbers are then the same
+    as with one call per column, in order.
+    y, if given, are the uniform random numbers to transform, of the shape of m, e.g. one row of
+    random_state.random_sample((n_columns, n_samples)) drawn for a whole factor; random_state is then not used.
     Adapted from randr function at http://mikkelschmidt.dk/code/gibbsnmf.html
     which is Copyright 2007 Mikkel N. Schmidt, ms@it.dk, www.mikkelschmidt.dk
     """
-    if isinstance(random_state, np.random.RandomState):
-        rs = random_state
-    else:
-        rs = np.random.RandomState(seed=random_state)
+    m = np.asarray(m, dtype=float)
+    if y is None:
+        rs = random_state if isinstance(random_state, np.random.RandomState) else \
+            np.random.RandomState(seed=random_state)
+        y = rs.random_sample(m.shape)
     sqrt_2s = np.sqrt(2 * s)
     ls = l * s
     lsm = ls - m
     A = lsm / sqrt_2s
-    a = A > 26
-    x = np.zeros(m.shape)
-    y = rs.random_sample(m.shape)
-    x[a] = -np.log(y[a]) / (lsm[a] / s)
-    na = np.logical_not(a)
-    R = erfc(abs(A[na]))
-    x[na] = erfcinv(y[na] * R - (A[na] < 0) * (2 * y[na] + R - 2)) * sqrt_2s + m[na] - ls[na]
-    x[np.isnan(x)] = 0
-    x[x < 0] = 0
-    x[np.isinf(x)] = 0
-    return x.real
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # far in the upper tail, the distribution is approximately exponential
+        x_tail = -np.log(y) / (lsm / s)
+        R = erfc(abs(A))
+        x = erfcinv(y * R - (A < 0) * (2 * y + R - 2)) * sqrt_2s + m - ls
+    x = np.where(A > 26, x_tail, x)
+    x[~np.isfinite(x) | (x < 0)] = 0
+    return x
 
 
 def truncated_normal_pdf(x, m, s, l, log=False):
@@ -496,31 +832,21 @@ def truncated_normal_pdf(x, m, s, l, log=False):
     plt.plot(xs, truncated_normal_pdf(xs, np.zeros_like(xs), 1, np.ones_like(xs)))
     plt.show()
 
-    Would it be possible to use scipy.stats.truncnorm instead?
+    The normalizing mass above 0, norm.sf(-newm / std), is evaluated in log space (log_ndtr),
+    so that densities far in the tails do not underflow.
 
     :param x: values at which to evaluate the density
     :param m: means of normal distributions
-    :param s: variance (scalar)
+    :param s: variance (scalar, or broadcasting against x)
     :param l: scale parameters from exponential distribution
     :param log: whether to return log of pdf
     :return:
     """
-    pdf = np.array(x)
-    pdf[x < 0] = 0
-    nn = [x >= 0]
+    x = np.asarray(x, dtype=float)
     newm = m - s * l
     std = np.sqrt(s)
-    stdn = scipy.stats.norm()
+    log_pdf = (-0.5 * np.square((x - newm) / std) - np.log(std) - 0.5 * math.log(2 * math.pi) -
+               log_ndtr(newm / std))
     if log:
-        pdf[x < 0] = LOG_ZERO
-        normpdf = scipy.stats.norm(loc=newm[nn], scale=std).logpdf(x[nn])
-        log_denom = math.log(std) + math_log(stdn.sf(- newm[nn] / std).clip(min=MACHINE_PREC))
-        pdf[nn] = np.subtract(normpdf, log_denom)
-    else:
-        pdf[x < 0] = 0
-        normpdf = scipy.stats.norm(loc=newm[nn], scale=std).pdf(x[nn])
-        denom = std * stdn.sf(- newm[nn] / std).clip(min=MACHINE_PREC)
-        pdf[nn] = np.divide(normpdf, denom)
-    return pdf
-
-
+        return np.where(x < 0, LOG_ZERO, log_pdf)
+    return np.where(x < 0, 0., np.exp(log_pdf))
@@ -0,0 +1,214 @@
+"""
+Timings of the optimized code paths against the implementations they replace.
+Each benchmark_* function returns a pd.Series of timings (seconds) and the largest
+absolute difference between the two results, e.g.
+    from modules.benchmarks import benchmark_ssgsea
+    benchmark_ssgsea(n_samples=100)
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+
+def timed(func, *args, **kwargs):
+    t = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - t
+
+
+def random_genesets(genes, n_sets, set_size, rs):
+    return {'set{}'.format(i): set(rs.choice(genes, size=set_size, replace=False)) for i in range(n_sets)}
+
+
+def benchmark_ssgsea(n_samples=1000, n_genes=20000, n_sets=20, set_size=150, alpha=0.75, n_jobs=-1, random_state=0):
+    """
+    Per-sample loop (ssgsea(method='loop')) vs. batch engine (ssgsea_batch()), serial and over n_jobs threads.
+    Defaults mimic projecting PDX disease signatures onto ~1000 cell lines.
+    """
+    from modules.gsea import ssgsea, ssgsea_batch
+    rs = np.random.RandomState(random_state)
+    genes = np.array(['g{}'.format(i) for i in range(n_genes)])
+    exp = pd.DataFrame(rs.normal(size=(n_samples, n_genes)), columns=genes)
+    sets_to_genes = random_genesets(genes, n_sets, set_size, rs)
+    loop_scores, loop_time = timed(ssgsea, exp, sets_to_genes, alpha=alpha, n_jobs=n_jobs, method='loop')
+    batch_scores, batch_time = timed(ssgsea_batch, exp, sets_to_genes, alpha=alpha)
+    threaded_scores, threaded_time = timed(ssgsea_batch, exp, sets_to_genes, alpha=alpha, n_jobs=n_jobs,
+                                           backend='threading')
+    max_abs_diff = max(np.abs(loop_scores.values - batch_scores.loc[:, loop_scores.columns].values).max(),
+                       np.abs(threaded_scores.values - batch_scores.values).max())
+    return pd.Series({'loop': loop_time, 'batch': batch_time, 'batch_threads': threaded_time,
+                      'max_abs_diff': max_abs_diff})
+
+
+def benchmark_bcv(n_samples=1000, n_vars=500, nan_fraction=0.05, random_state=0):
+    """
+    R's MASS::bcv through rpy2, one column at a time, vs. bcv() on all columns at once.
+    Also serves to validate bcv() against R; requires rpy2 and R's MASS package.
+    """
+    from modules.information import compute_bandwidths
+    rs = np.random.RandomState(random_state)
+    X = rs.normal(size=(n_samples, n_vars)) * rs.uniform(0.1, 10, size=n_vars)
+    X[rs.random_sample(X.shape) < nan_fraction] = np.nan
+    columns = [X[~np.isnan(X[:, i]), i][:, np.newaxis] for i in range(n_vars)]
+    r_bandwidths, r_time = timed(lambda: np.array([compute_bandwidths(x, bandwidth_method='r')[0] for x in columns]))
+    numpy_bandwidths, numpy_time = timed(compute_bandwidths, X, bandwidth_method='numpy')
+    max_abs_diff = np.abs(r_bandwidths - numpy_bandwidths).max()
+    return pd.Series({'r': r_time, 'numpy': numpy_time, 'max_abs_diff': max_abs_diff})
+
+
+def benchmark_normalize(n_samples=1000, n_genes=20000, n_loop_genes=2000, random_state=0):
+    """
+    Row-by-row rankdata() and the per-rank quantile loop vs. rank_normalize() and quantile_normalize().
+    The per-rank loop is O(n_genes ** 2), so it is only timed on the first n_loop_genes genes.
+    """
+    from scipy.stats import rankdata
+    from modules.local_utils import rank_normalize, quantile_normalize
+    rs = np.random.RandomState(random_state)
+    x = np.round(rs.lognormal(size=(n_samples, n_genes)), 3)  # rounded so there are ties
+
+    def loop_rank_normalize(s):
+        ranks = np.array([rankdata(s[i], method='dense') for i in range(s.shape[0])]) - 1
+        return ranks / (s.shape[1] - 1)
+
+    def loop_quantile_normalize(s):
+        ranks = np.array([rankdata(s[i], method='dense') for i in range(s.shape[0])]) - 1
+        col_means = np.mean(np.sort(s, axis=1), axis=0)
+        ranks_copy = ranks.copy().astype(float)
+        for rank in range(ranks.shape[1]):
+            ranks_copy[ranks == rank] = col_means[rank]
+        return ranks_copy
+
+    loop_ranks, loop_rank_time = timed(loop_rank_normalize, x)
+    ranks, rank_time = timed(rank_normalize, x)
+    loop_quantiles, loop_quantile_time = timed(loop_quantile_normalize, x[:, :n_loop_genes])
+    _, quantile_time = timed(quantile_normalize, x)
+    subset_quantiles = quantile_normalize(x[:, :n_loop_genes])
+    max_abs_diff = max(np.abs(loop_ranks - ranks).max(), np.abs(loop_quantiles - subset_quantiles).max())
+    return pd.Series({'loop_rank_normalize': loop_rank_time,
+                      'rank_normalize': rank_time,
+                      'loop_quantile_normalize ({} genes)'.format(n_loop_genes): loop_quantile_time,
+                      'quantile_normalize': quantile_time,
+                      'max_abs_diff': max_abs_diff})
+
+
+def benchmark_gsea(n_perms=1000, n_sets=50, n_genes=20000, n_samples=40, set_size=150, n_loop_perms=10,
+                   alpha=0.75, random_state=0):
+    """
+    Classic GSEA nulls: one _base_gsea(collect_func=max_deviation) call per permutation vs. gsea(),
+    with phenotype and gene-set permutations. The loop is only timed on n_loop_perms permutations;
+    its scores are compared with _batch_gsea() on the same ranked lists.
+    """
+    from modules.gsea import gsea, _base_gsea, _batch_gsea, max_deviation, make_membership_matrix
+    rs = np.random.RandomState(random_state)
+    genes = np.array(['g{}'.format(i) for i in range(n_genes)])
+    exp = pd.DataFrame(rs.normal(size=(n_samples, n_genes)), columns=genes)
+    phenotype = np.arange(n_samples) < n_samples // 2
+    sets_to_genes = random_genesets(genes, n_sets, set_size, rs)
+    membership, set_names = make_membership_matrix(genes, sets_to_genes)
+    positions = np.array([rs.permutation(n_genes) for _ in range(n_loop_perms)])
+
+    def loop_nulls():
+        return np.array([_base_gsea(genes[np.argsort(perm_positions)], sets_to_genes, max_deviation, alpha=alpha)
+                         .loc[set_names].values for perm_positions in positions]).T
+
+    def batch_nulls():
+        set_positions = [positions[:, membership.indices[start:stop]]
+                         for start, stop in zip(membership.indptr[:-1], membership.indptr[1:])]
+        return np.array([_batch_gsea(p, (p + 1.) ** alpha, n_genes) for p in set_positions])
+
+    loop_es, loop_time = timed(loop_nulls)
+    batch_es, batch_time = timed(batch_nulls)
+    _, phenotype_time = timed(gsea, exp, sets_to_genes, phenotype=phenotype, n_perms=n_perms, random_state=rs)
+    _, gene_set_time = timed(gsea, exp, sets_to_genes, phenotype=phenotype, permutation_type='gene_set',
+                             n_perms=n_perms, random_state=rs)
+    return pd.Series({'loop ({} perms)'.format(n_loop_perms): loop_time,
+                      '_batch_gsea ({} perms)'.format(n_loop_perms): batch_time,
+                      'gsea phenotype ({} perms)'.format(n_perms): phenotype_time,
+                      'gsea gene_set ({} perms)'.format(n_perms): gene_set_time,
+                      'max_abs_diff': np.abs(loop_es - batch_es).max()})
+
+
+def benchmark_truncated_normal(n_components=5, n_samples=20000, n_features=100, n_iter=20, random_state=0):
+    """
+    Gibbs iterations of BayesianNMF.fit(mode='gibbs') on an (n_samples, n_features) matrix vs. the loop it replaced,
+    with one masked sampler call, and its own random draw, per column of A and row of B.
+    Both start from the same factors and seed; timings are per iteration, averaged over n_iter,
+    and max_abs_diff compares all samples of A, B and the variance.
+    """
+    import scipy.stats
+    from scipy.special import erfc, erfcinv
+    from modules.bayesian_nmf import BayesianNMF, MACHINE_PREC
+    rs = np.random.RandomState(random_state)
+    X = (rs.exponential(size=(n_samples, n_components)).dot(rs.exponential(size=(n_components, n_features))) +
+         rs.exponential(scale=0.1, size=(n_samples, n_features)))
+    A_init = rs.exponential(size=(n_samples, n_components))
+    B_init = rs.exponential(scale=n_components / X.mean(), size=(n_components, n_features))
+    variance_init = np.var(X - np.dot(A_init, B_init))
+
+    def loop_sample(m, s, l, rs):
+        sqrt_2s = np.sqrt(2 * s)
+        ls = l * s
+        lsm = ls - m
+        A = lsm / sqrt_2s
+        a = A > 26
+        x = np.zeros(m.shape)
+        y = rs.random_sample(m.shape)
+        x[a] = -np.log(y[a]) / (lsm[a] / s)
+        na = np.logical_not(a)
+        R = erfc(abs(A[na]))
+        x[na] = erfcinv(y[na] * R - (A[na] < 0) * (2 * y[na] + R - 2)) * sqrt_2s + m[na] - ls[na]
+        x[np.isnan(x)] = 0
+        x[x < 0] = 0
+        x[np.isinf(x)] = 0
+        return x.real
+
+    def loop_fit():
+        # the Gibbs loop of BayesianNMF.fit with its default priors, as it was before sampling per factor
+        loop_rs = np.random.RandomState(random_state)
+        A, B, mu2 = A_init.copy(), B_init.copy(), variance_init
+        I, J = X.shape
+        N = n_components
+        alpha = np.ones((I, N))
+        beta = np.ones((N, J)) * N / X.mean()
+        chi = 0.5 * np.square(X).sum()
+        As, Bs, mu2s = [], [], []
+        for _ in range(n_iter):
+            C = np.dot(B, B.T)
+            D = np.dot(X, B.T)
+            for n in range(N):
+                notn = list(range(n)) + list(range(n + 1, N))
+                an = (D[:, n] - np.dot(A[:, notn], C[notn, n]) - alpha[:, n] * mu2) / (C[n, n] + MACHINE_PREC)
+                A[:, n] = loop_sample(an, mu2 / (C[n, n] + MACHINE_PREC), alpha[:, n], loop_rs)
+            xi = 0.5 * np.multiply(A, np.dot(A, C) - (2 * D)).sum()
+            mu2 = scipy.stats.invgamma.rvs(a=(I * J / 2) + 1, scale=chi + xi, random_state=loop_rs)
+            E = np.dot(A.T, A)
+            F = np.dot(A.T, X)
+            for n in range(N):
+                notn = list(range(n)) + list(range(n + 1, N))
+                bn = (F[n] - np.dot(E[n, notn], B[notn]) - beta[n] * mu2) / (E[n, n] + MACHINE_PREC)
+                B[n] = loop_sample(bn, mu2 / (E[n, n] + MACHINE_PREC), beta[n], loop_rs)
+            As.append(A.copy())
+            Bs.append(B.copy())
+            mu2s.append(mu2)
+        return [np.array(As), np.array(Bs), np.array(mu2s)]
+
+    def gibbs_fit():
+        model = BayesianNMF(n_components, mode='gibbs', max_iter=n_iter, mean_only=False, random_state=random_state)
+        model.fit(X, bases_init=A_init.copy(), components_init=B_init.copy(), variance_init=variance_init)
+        return [np.concatenate([model.burnin_bases_samples_, model.bases_samples_]),
+                np.concatenate([model.burnin_components_samples_, model.components_samples_]),
+                np.concatenate([model.burnin_variance_samples_, model.variance_samples_])]
+
+    loop_samples, loop_time = timed(loop_fit)
+    fit_samples, fit_time = timed(gibbs_fit)
+    max_abs_diff = max(np.abs(loop - fitted).max() for loop, fitted in zip(loop_samples, fit_samples))
+    return pd.Series({'loop': loop_time / n_iter, 'fit': fit_time / n_iter, 'max_abs_diff': max_abs_diff})
+
+
+if __name__ == '__main__':
+    print(benchmark_ssgsea())
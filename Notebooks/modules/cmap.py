@@ -6,7 +6,7 @@ import pandas as pd
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
 
 from modules.utils import merge_redundant_series
-from modules.controls import make_dx_disease_gdict
+from modules.controls import make_dx_disease_gdicts
 
 cmap_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -14,8 +14,8 @@ cmap_dir = os.path.dirname(os.path.abspath(__file__))
 def make_cmap_genesets(exp, control_exp, valid_genes_file, method='rankdif'):
     with open(valid_genes_file, 'r') as f:
         valid_genes = [line.strip() for line in f]
-    up_gsets = make_dx_disease_gdict(exp, control_exp, n_genes=150, up=True, method=method, valid_genes=valid_genes, sets=False)
-    dn_gsets = make_dx_disease_gdict(exp, control_exp, n_genes=150, up=False, method=method, valid_genes=valid_genes, sets=False)
+    up_gsets, dn_gsets = make_dx_disease_gdicts(exp, control_exp, n_genes=150, up=(True, False), method=method,
+                                                valid_genes=valid_genes, sets=False)
     return up_gsets, dn_gsets
 
 
@@ -1,6 +1,9 @@
 import os
 import json
+import shutil
 import sys
+import tempfile
+import time
 
 import pandas as pd
 import numpy as np
@@ -8,15 +11,21 @@ import numpy.ma as ma
 import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib import gridspec
+import joblib
 from joblib import Parallel, delayed
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
 
 from modules.controls import make_dx_disease_gdict
-from modules.gsea import ssgsea
-from modules.information import compute_ic
+from modules.gsea import ssgsea, rank_genes
+from modules.information import compute_ic, BandwidthCache
+from modules.results_store import ResultsStore, hash_inputs, same_source, file_sha1
 
 supported_cls = 'gdsc ctrp ccle'.split()
+supported_backends = 'loky multiprocessing threading'.split()
+sign_flipped_cls = ['gdsc', 'ctrp']  # so that for every database, higher drug response means more sensitive
+loaded_cl_stores = {}  # hdf_file: (source stats, cl_exp, cl_dr), reused by every call in this process
+cl_exp_ranks = {}  # hdf_file: (store SHA-1, column labels, rank_genes(cl_exp.values))
 
 
 def load_discover_drug_to_cids(discover_data_dir, cls):
@@ -36,6 +45,114 @@ def load_cl_drug_to_cids(discover_data_dir, cl, prefix=False):
     return to_cid
 
 
+def load_cl_store(discover_data_dir, cl, cache_dir=None, use_cache=True):
+    """
+    Cell-line expression and drug response of one database, with the sign convention of
+    sign_flipped_cls already applied.
+
+    store.h5 is converted once into .npy matrices (memory-mapped when loaded) plus an index file,
+    written to cache_dir, and the result is also kept in memory for the rest of the process.
+    Both caches are invalidated when store.h5 changes: a different size or mtime triggers
+    a SHA-1 comparison, and a different hash a rebuild.
+    :param discover_data_dir: str, directory with one subdirectory (containing store.h5) per database
+    :param cl: str, one of supported_cls
+    :param cache_dir: str, where to write the converted store. Defaults to the database's directory.
+        If it cannot be written to, only the in-memory cache is used.
+    :param use_cache: bool, if False, read store.h5 directly
+    :return: cl_exp, cl_dr, Pandas DataFrames with cell lines as rows. They are shared between calls,
+        so copy them before modifying them in place.
+    """
+    if cl not in supported_cls:
+        raise ValueError('{} not a supported cl; try one of {}'.format(cl, supported_cls))
+    hdf_file = os.path.join(discover_data_dir, cl, 'store.h5')
+    if not use_cache:
+        return read_cl_store(hdf_file, cl)
+    stat = os.stat(hdf_file)
+    source = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if hdf_file in loaded_cl_stores:
+        loaded_source, cl_exp, cl_dr = loaded_cl_stores[hdf_file]
+        if same_source(loaded_source, source, hdf_file):
+            source['sha1'] = loaded_source['sha1']
+            loaded_cl_stores[hdf_file] = (source, cl_exp, cl_dr)
+            return cl_exp, cl_dr
+    if cache_dir is None:
+        cache_dir = os.path.join(discover_data_dir, cl, 'store_cache')
+    index_file = os.path.join(cache_dir, 'index.json')
+    cached = None
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as f:
+            cached = json.load(f)
+        if not same_source(cached['source'], source, hdf_file):
+            cached = None
+    if cached is None:
+        cl_exp, cl_dr = read_cl_store(hdf_file, cl)
+        source['sha1'] = file_sha1(hdf_file)
+        try:
+            write_cl_store_cache(cache_dir, source, cl_exp, cl_dr)
+        except OSError as e:
+            print('Could not cache {} in {}: {}'.format(hdf_file, cache_dir, e))
+    else:
+        source['sha1'] = cached['source']['sha1']
+        if cached['source'] != source:
+            # touched but unchanged; record the new mtime so the hash isn't recomputed next time
+            cached['source'] = source
+            with open(index_file, 'w') as f:
+                json.dump(cached, f)
+        cl_exp, cl_dr = [read_cl_store_cache(cache_dir, cached, name) for name in ['exp', 'dr']]
+    loaded_cl_stores[hdf_file] = (source, cl_exp, cl_dr)
+    return cl_exp, cl_dr
+
+
+def read_cl_store(hdf_file, cl):
+    cl_exp = pd.read_hdf(hdf_file, 'exp')
+    cl_dr = pd.read_hdf(hdf_file, 'dr')
+    # they are already reduced to cell lines they have in common
+    # exp_df, dr_df = reduce_to_common_idxs([exp_df, dr_df], axis=1)
+    if cl in sign_flipped_cls:
+        cl_dr *= -1
+    return cl_exp, cl_dr
+
+
+def write_cl_store_cache(cache_dir, source, cl_exp, cl_dr):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    index = {'source': source}
+    for name, df in [('exp', cl_exp), ('dr', cl_dr)]:
+        np.save(os.path.join(cache_dir, '{}.npy'.format(name)), df.values.astype(float))
+        index[name] = {'index': df.index.tolist(), 'index_name': df.index.name,
+                       'columns': df.columns.tolist(), 'columns_name': df.columns.name}
+    # written last, so an interrupted write leaves no valid index
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+def read_cl_store_cache(cache_dir, index, name):
+    """
+    :return: Pandas DataFrame backed by the memory-mapped .npy file of name ('exp' or 'dr')
+    """
+    npy_file = os.path.join(cache_dir, '{}.npy'.format(name))
+    values = np.load(npy_file, mmap_mode='c')
+    # without copy=False, pandas >= 3 copies the array into memory
+    df = pd.DataFrame(values, copy=False,
+                      index=pd.Index(index[name]['index'], name=index[name]['index_name']),
+                      columns=pd.Index(index[name]['columns'], name=index[name]['columns_name']))
+    if not np.shares_memory(df.values, values):
+        print('{} was copied into memory instead of memory-mapped'.format(npy_file))
+    return df
+
+
+def rank_cl_exp(discover_data_dir, cl):
+    """
+    rank_genes() of the cell-line expression of load_cl_store(), computed once per version of the database
+    """
+    cl_exp, _ = load_cl_store(discover_data_dir, cl)
+    hdf_file = os.path.join(discover_data_dir, cl, 'store.h5')
+    version, columns = cl_store_version(discover_data_dir, cl), cl_exp.columns.tolist()
+    if hdf_file not in cl_exp_ranks or cl_exp_ranks[hdf_file][:2] != (version, columns):
+        cl_exp_ranks[hdf_file] = (version, columns, rank_genes(cl_exp.values.astype(float)))
+    return cl_exp_ranks[hdf_file][2]
+
+
 def make_discover_genesets(exp, control_exp, cl_exp=None, method='rankdif'):
     if cl_exp is None:
         valid_genes = None
@@ -53,46 +170,179 @@ def discover_from_expression(discover_data_dir, exp, control_exp, alpha=0.75, ve
     return discover(discover_data_dir, exp=exp, control_exp=control_exp, alpha=alpha, verbose=verbose)
 
 
+def discover_cohort(discover_data_dir, cohort, control_exp, alpha=0.75, method='rankdif', verbose=False):
+    """
+    DiSCoVER for many samples in one pass: each database is loaded and each cell line's expression
+    sorted once, all signatures are projected together, and all ICs computed in one scheduler run.
+    :param cohort: Pandas DataFrame of expression, (n_samples, n_genes),
+        or dict of sample name to Pandas Series (n_genes,) or one-row DataFrame; samples may cover different genes
+    :param control_exp: Pandas DataFrame, one row of control expression
+    :return: Pandas DataFrame, (n_samples, n_drugs), in the layout of discover()
+    """
+    exps = cohort_exps(cohort)
+    # as in discover(), signatures are restricted to genes measured in CTRP
+    cl_exp, _ = load_cl_store(discover_data_dir, 'ctrp')
+    disease_gdict = {}
+    for exp in exps:
+        disease_gdict.update(make_discover_genesets(exp, control_exp, cl_exp=cl_exp, method=method))
+    return discover(discover_data_dir, disease_gdict=disease_gdict, alpha=alpha, verbose=verbose)
+
+
+def discover_incremental(discover_data_dir, cohort, control_exp, results_dir, alpha=0.75, method='rankdif',
+                         verbose=False):
+    """
+    discover_cohort(), computing only samples without stored results for the same inputs.
+    Results are stored per sample in results_dir (see ResultsStore), keyed by a hash of the sample's
+    expression, the control expression, method, alpha and the versions (SHA-1) of the cell-line stores.
+    :return: Pandas DataFrame, (n_samples, n_drugs), in the layout of discover()
+    """
+    exps = cohort_exps(cohort)
+    cl_store_versions = [cl_store_version(discover_data_dir, cl_name) for cl_name in 'ctrp gdsc ccle'.split()]
+    sample_hashes = {sample: hash_inputs(exp.loc[sample], control_exp, method, alpha, cl_store_versions)
+                     for exp in exps for sample in exp.index}
+    store = ResultsStore(results_dir, suffix='discover')
+    stale = store.stale_samples(sample_hashes)
+    if verbose:
+        print('DiSCoVER results missing or out of date for {} of {} samples'.format(len(stale), len(sample_hashes)))
+    if len(stale) > 0:
+        stale_cohort = {sample: exp.loc[[sample]] for exp in exps for sample in exp.index if sample in stale}
+        new_results = discover_cohort(discover_data_dir, stale_cohort, control_exp, alpha=alpha, method=method,
+                                      verbose=verbose)
+        for sample in stale:
+            store.put(sample, sample_hashes[sample], new_results.loc[[sample]])
+    return pd.concat([store.get(sample) for sample in sample_hashes], axis=0)
+
+
+def cohort_exps(cohort):
+    """
+    :param cohort: Pandas DataFrame (n_samples, n_genes), or dict of sample name to Pandas Series or one-row DataFrame
+    :return: list of Pandas DataFrames with sample names as index
+    """
+    if isinstance(cohort, pd.DataFrame):
+        return [cohort]
+    elif isinstance(cohort, dict):
+        return [exp.to_frame(name=sample).T if isinstance(exp, pd.Series) else exp.rename(index={exp.index[0]: sample})
+                for sample, exp in cohort.items()]
+    raise ValueError("cohort must be Pandas DataFrame or dict")
+
+
+def cl_store_version(discover_data_dir, cl):
+    """
+    :return: str, SHA-1 of the database's store.h5
+    """
+    load_cl_store(discover_data_dir, cl)
+    source, _, _ = loaded_cl_stores[os.path.join(discover_data_dir, cl, 'store.h5')]
+    return source['sha1']
+
+
 def discover(discover_data_dir, exp=None, control_exp=None, disease_gdict=None, alpha=0.75, verbose=False):
     cl_names = 'ctrp gdsc ccle'.split()
     all_ics = []
+    bandwidth_cache = BandwidthCache()
     for cl_name in cl_names:
         if verbose:
             print("Loading {}".format(cl_name.upper()))
-        hdf_file = os.path.join(discover_data_dir, cl_name, 'store.h5')
-        cl_exp = pd.read_hdf(hdf_file, 'exp')
-        cl_dr = pd.read_hdf(hdf_file, 'dr')
-        # they are already reduced to cell lines they have in common
-        # exp_df, dr_df = reduce_to_common_idxs([exp_df, dr_df], axis=1)
-        if cl_name in ['gdsc', 'ctrp']:
-            cl_dr *= -1
+        cl_exp, cl_dr = load_cl_store(discover_data_dir, cl_name)
         if verbose:
             print('Projecting disease gene sets')
         if disease_gdict is None:
             disease_gdict = make_discover_genesets(exp, control_exp, cl_exp=cl_exp)
-        ssgsea_df = ssgsea(cl_exp, disease_gdict, alpha=alpha, n_jobs=-1)
+        ssgsea_df = ssgsea(cl_exp, disease_gdict, alpha=alpha, n_jobs=-1, ranks=rank_cl_exp(discover_data_dir, cl_name))
         if verbose:
             print('Matching to drug response profiles')
-        ics = compute_discover_ics(ssgsea_df, cl_dr, n_jobs=-1)
+        ics = compute_discover_ics(ssgsea_df, cl_dr, n_jobs=-1, bandwidth_cache=bandwidth_cache, verbose=verbose)
+        if verbose:
+            print('Bandwidth cache: {}'.format(bandwidth_cache.stats()))
         ics.columns = ['{}_{}'.format(cl_name, idx) for idx in ics.columns]
         all_ics.append(ics)
     combined_results = pd.concat(all_ics, axis=1)
     return combined_results
 
 
-def compute_discover_ics(ssgsea_df, dr_df, n_jobs=1):
+def compute_discover_ics(ssgsea_df, dr_df, n_jobs=1, bandwidth_cache=None, backend='loky', chunk_size=None,
+                         verbose=False):
+    """
+    ICs of every disease signature with every drug response profile.
+    Workers get blocks of drug columns; the input matrices are memory-mapped once rather than
+    pickled per pair, and finished blocks are written into one preallocated array.
+    :param ssgsea_df: Pandas DataFrame, (n_cell_lines, n_diseases)
+    :param dr_df: Pandas DataFrame, (n_cell_lines, n_drugs)
+    :param bandwidth_cache: BandwidthCache, optional, to reuse bandwidths across calls
+    :param backend: joblib backend, one of 'loky', 'multiprocessing' or 'threading'
+    :param chunk_size: int, number of drugs per task. By default each worker gets about 4 blocks.
+    :param verbose: bool, whether to print progress and throughput
+    :return: Pandas DataFrame of ICs, (n_diseases, n_drugs)
+    """
+    if backend not in supported_backends:
+        raise ValueError('{} not a supported backend; try one of {}'.format(backend, supported_backends))
     if n_jobs == -1:
         n_jobs = os.cpu_count()
+    if bandwidth_cache is None:
+        bandwidth_cache = BandwidthCache()
     diseases = ssgsea_df.columns
     drugs = dr_df.columns
     n_diseases = len(diseases)
     n_drugs = len(drugs)
-    ic_inputs = [(ssgsea_df.loc[:, disease], dr_df.loc[:, drug]) for disease in diseases for drug in drugs]
-    ics_list = Parallel(n_jobs=n_jobs)(delayed(compute_ic)(*inputs) for inputs in ic_inputs)
-    ics = pd.DataFrame(np.array(ics_list).reshape((n_diseases, n_drugs)), index=diseases, columns=drugs)
+    disease_values = ssgsea_df.values.astype(float)
+    drug_values = dr_df.values.astype(float)
+    pair_idxs = [(i, j) for i in range(n_diseases) for j in range(n_drugs)]
+    overlaps = [~np.isnan(disease_values[:, i]) & ~np.isnan(drug_values[:, j]) for i, j in pair_idxs]
+    disease_bandwidths = bandwidth_cache.get_bandwidths([(disease_values[:, i], overlap)
+                                                        for (i, j), overlap in zip(pair_idxs, overlaps)])
+    drug_bandwidths = bandwidth_cache.get_bandwidths([(drug_values[:, j], overlap)
+                                                     for (i, j), overlap in zip(pair_idxs, overlaps)])
+    disease_bandwidths = disease_bandwidths.reshape((n_diseases, n_drugs))
+    drug_bandwidths = drug_bandwidths.reshape((n_diseases, n_drugs))
+    if chunk_size is None:
+        chunk_size = max(1, int(np.ceil(n_drugs / (4 * n_jobs))))
+    chunks = [(start, min(start + chunk_size, n_drugs)) for start in range(0, n_drugs, chunk_size)]
+    ics = np.empty((n_diseases, n_drugs))
+    temp_dir = None
+    if backend != 'threading':
+        temp_dir = tempfile.mkdtemp(prefix='discover_ics_')
+        disease_values, drug_values = [memmap_array(values, os.path.join(temp_dir, name)) for values, name in
+                                       [(disease_values, 'disease_values.mmap'), (drug_values, 'drug_values.mmap')]]
+    try:
+        t = time.time()
+        n_done = 0
+        with Parallel(n_jobs=n_jobs, backend=backend) as parallel:
+            for wave_start in range(0, len(chunks), 2 * n_jobs):
+                wave = chunks[wave_start:wave_start + 2 * n_jobs]
+                blocks = parallel(delayed(compute_ic_block)(disease_values, drug_values, start, stop,
+                                                            disease_bandwidths[:, start:stop],
+                                                            drug_bandwidths[:, start:stop])
+                                  for start, stop in wave)
+                for (start, stop), block in zip(wave, blocks):
+                    ics[:, start:stop] = block
+                    n_done += block.size
+                if verbose:
+                    elapsed = time.time() - t
+                    print('{}/{} ICs computed, {:.1f} ICs per second'.format(n_done, ics.size, n_done / elapsed))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    ics = pd.DataFrame(ics, index=diseases, columns=drugs)
     return ics
 
 
+def memmap_array(values, path):
+    joblib.dump(values, path)
+    return joblib.load(path, mmap_mode='r')
+
+
+def compute_ic_block(disease_values, drug_values, start, stop, disease_bandwidths, drug_bandwidths):
+    """
+    :return: array, (n_diseases, stop - start), ICs of every disease with drugs start to stop
+    """
+    n_diseases = disease_values.shape[1]
+    block = np.empty((n_diseases, stop - start))
+    for i in range(n_diseases):
+        for j in range(start, stop):
+            block[i, j - start] = compute_ic(disease_values[:, i], drug_values[:, j],
+                                             bandwidths=[disease_bandwidths[i, j - start], drug_bandwidths[i, j - start]])
+    return block
+
+
 def plot_discover_from_signature(sample_name, discover_results, disease_gdict, cl='ctrp', alpha=0.75, out_file=None, min_nonnull_frac=0.5):
     return plot_discover(sample_name, discover_results, disease_gdict=disease_gdict, cl=cl, alpha=alpha, out_file=out_file, min_nonnull_frac=min_nonnull_frac)
 
@@ -102,11 +352,9 @@ def plot_discover_from_expression(sample_name, discover_results, exp, control_ex
 
 
 def plot_discover(discover_data_dir, sample_name, discover_results, disease_gdict=None, exp=None, control_exp=None, cl='ctrp', alpha=0.75, out_file=None, min_nonnull_frac=0.5):
-    hdf_file = os.path.join(discover_data_dir, cl, 'store.h5')
-    cl_exp = pd.read_hdf(hdf_file, 'exp')
-    cl_dr = pd.read_hdf(hdf_file, 'dr')
-    if cl in ['ctrp', 'gdsc']:
-        cl *= -1
+    cl_exp, cl_dr = load_cl_store(discover_data_dir, cl)
+    if cl in sign_flipped_cls:
+        cl_dr = -cl_dr  # plot viabilities as measured, as before the cache flipped signs when loading
 
     if disease_gdict is None:
         disease_gdict = make_discover_genesets(exp, control_exp, cl_exp=cl_exp)
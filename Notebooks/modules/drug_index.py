@@ -0,0 +1,251 @@
+"""
+One index of drug identities, built from the drug annotation files and kept on disk, so that annotating
+drug rankings for many samples does not re-read drug_source_moa_annotations.xlsx every time.
+Lookups go name -> PubChem CIDs -> clinically relevant (canonical) drug -> MoA, e.g.
+    index = load_drug_index(drug_annotation_dir, discover_data_dir=discover_data_dir)
+    index.annotate_moa(ranked_drugs.columns, index.drug_to_cids)
+"""
+import os
+import sys
+import json
+import pickle
+import itertools
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from modules.results_store import file_sources, same_sources, file_sha1
+
+drug_index_version = 1  # bump when DrugIndex changes, so that pickled indexes are rebuilt
+drug_index_cls = 'gdsc ctrp ccle'.split()
+loaded_drug_indexes = {}  # cache_file: (sources, DrugIndex)
+
+
+class DrugIndex(object):
+    """
+    Parameters
+    ----------
+    rdrug_to_cids : dict
+        Clinically relevant drug to list of int CIDs, in the order of the annotation spreadsheet.
+    rdrug_mechs : dict
+        Lowercase clinically relevant drug to MoA ('NCI +' sheet).
+    drug_to_cids : dict, optional
+        Database-prefixed drug name (e.g. 'ctrp_navitoclax') to CIDs, from the *_name_to_pubchem_cid.json files.
+    drugbank : Pandas DataFrame, optional
+        drugbank.tsv, indexed by lowercase drug name.
+    pharm_classes : Pandas DataFrame, optional
+        FDA pharmacological classes (moa, drug_class), indexed by lowercase drug name.
+    """
+
+    def __init__(self, rdrug_to_cids, rdrug_mechs, drug_to_cids=None, drugbank=None, pharm_classes=None):
+        self.rdrug_to_cids = rdrug_to_cids
+        self.rdrug_mechs = rdrug_mechs
+        self.drug_to_cids = {} if drug_to_cids is None else drug_to_cids
+        self.drugbank = drugbank
+        self.pharm_classes = pharm_classes
+        # later drugs take precedence for CIDs shared by several, as when the dict was built per call
+        self.cid_to_rdrug = {cid: rdrug for rdrug, cids in rdrug_to_cids.items() for cid in cids}
+        self.name_to_cids = {}
+        for drug, cids in self.drug_to_cids.items():
+            self.name_to_cids.setdefault(drug.lower(), list(cids))
+            self.name_to_cids.setdefault(strip_db_prefix(drug).lower(), list(cids))
+        for rdrug, cids in rdrug_to_cids.items():
+            self.name_to_cids[str(rdrug).lower()] = list(cids)
+
+    def cids(self, name):
+        """
+        :param name: str, drug name, with or without a database prefix, in any case
+        :return: list of int CIDs, empty if unknown
+        """
+        return self.name_to_cids.get(name.lower(), [])
+
+    def canonical_drug(self, name):
+        """
+        :return: str, the clinically relevant drug sharing a CID with name, or None
+        """
+        for cid in reversed(self.cids(name)):
+            if cid in self.cid_to_rdrug:
+                return self.cid_to_rdrug[cid]
+        return None
+
+    def moa(self, name):
+        """
+        :return: str, MoA of the canonical drug of name ('' if it has none), or None if name is not clinically relevant
+        """
+        rdrug = self.canonical_drug(name)
+        if rdrug is None:
+            return None
+        return self.rdrug_mechs.get(rdrug, '')
+
+    def reasonable_drugs(self, drug2cids):
+        """
+        :param drug2cids: dict of drug names to CIDs, e.g. self.drug_to_cids
+        :return: set of the drugs in drug2cids sharing a CID with a clinically relevant drug
+        """
+        return {drug for drug, cids in drug2cids.items() if any(cid in self.cid_to_rdrug for cid in cids)}
+
+    def annotate_moa(self, drugs, drug2cids, any_cid=True, unmatched=np.nan):
+        """
+        MoA of each drug, through the clinically relevant drug sharing one of its CIDs.
+        :param drugs: list-like of drug names, e.g. the index of a results frame
+        :param drug2cids: dict of drug names to CIDs
+        :param any_cid: bool, if True the last CID matching a clinically relevant drug is used and drugs
+            without one get NaN (as in subset_to_reasonable_drugs); if False only the last CID of each
+            drug is considered, and unmatched is used when it matches no drug or the drug has no CIDs
+            entry (as in companion_script.format_drugs)
+        :param unmatched: value for drugs that are not clinically relevant, with any_cid=False
+        :return: Pandas Series of MoAs indexed by drugs; '' for clinically relevant drugs without a MoA
+        """
+        drugs = pd.Index(drugs)
+        drug_cids = [drug2cids.get(drug, []) for drug in drugs]
+        positions = np.repeat(np.arange(len(drugs)), [len(cids) for cids in drug_cids])
+        rdrugs = pd.Series(list(itertools.chain(*drug_cids)), dtype=object).map(self.cid_to_rdrug)
+        mechs = rdrugs.map(self.rdrug_mechs)
+        mechs[rdrugs.notna() & mechs.isna()] = ''
+        moas = pd.Series(np.nan, index=drugs, dtype=object)
+        if any_cid:
+            matched = rdrugs.notna().values
+            pairs = pd.Series(mechs.values[matched], index=positions[matched])
+        else:
+            pairs = pd.Series(mechs.fillna(unmatched).values, index=positions)
+            moas.iloc[[i for i, drug in enumerate(drugs) if drug not in drug2cids]] = unmatched
+        last = pairs[~pairs.index.duplicated(keep='last')]
+        moas.iloc[last.index.values] = last.values
+        return moas
+
+    def external_annotations(self, drugs):
+        """
+        :param drugs: list-like of drug names, with or without a database prefix
+        :return: Pandas DataFrame indexed by drugs: fda_moa and fda_drug_class (if built with fda_file),
+            drugbank_id and drugbank_categories (if built with drugbank_file); NaN where not found
+        """
+        names = [strip_db_prefix(drug).lower() for drug in drugs]
+        annotations = pd.DataFrame(index=pd.Index(drugs))
+        if self.pharm_classes is not None:
+            fda = self.pharm_classes.reindex(names)
+            annotations['fda_moa'] = fda['moa'].values
+            annotations['fda_drug_class'] = fda['drug_class'].values
+        if self.drugbank is not None:
+            drugbank = self.drugbank.reindex(names)
+            for column, name in [('drugbank_id', 'drugbank_id'), ('categories', 'drugbank_categories')]:
+                if column in drugbank.columns:
+                    annotations[name] = drugbank[column].values
+        return annotations
+
+
+def strip_db_prefix(drug):
+    """
+    'ctrp_navitoclax' -> 'navitoclax'; names without a database prefix are returned unchanged
+    """
+    prefix, _, name = drug.partition('_')
+    return name if name and prefix.lower() in drug_index_cls + ['cmap'] else drug
+
+
+def read_drug_annotations(drug_annotation_dir):
+    """
+    :return: rdrug_to_cids, rdrug_mechs, from drug_source_moa_annotations.xlsx and clinically_relevant_drugs.csv
+    """
+    robfile = os.path.join(drug_annotation_dir, 'drug_source_moa_annotations.xlsx')
+    reasonable_drugs_file = os.path.join(drug_annotation_dir, 'clinically_relevant_drugs.csv')
+    with open(reasonable_drugs_file, 'r') as f:
+        reasonable_drugs = {row.strip() for row in f.readlines()}
+    # both sheets in one pass over the workbook
+    sheets = pd.read_excel(robfile, index_col=0, sheet_name=[0, 'NCI +'], dtype=str)
+    robdf = sheets[0]
+    hascid = robdf.cids.dropna()
+    rdrug_to_cids = {}
+    for drug, cids in zip(hascid.index, hascid.values):
+        if drug in reasonable_drugs:
+            cids = cids.split('|')
+            if cids != ['nan']:
+                rdrug_to_cids[drug] = list(map(int, cids))
+    mechs = sheets['NCI +'].iloc[:, 7].dropna()
+    rdrug_mechs = dict(zip([str(idx).lower() for idx in mechs.index], mechs.values))
+    return rdrug_to_cids, rdrug_mechs
+
+
+def read_drugbank(drugbank_file):
+    drugbank = pd.read_csv(drugbank_file, sep='\t', dtype=str)
+    drugbank.index = drugbank['name'].str.lower()
+    return drugbank[~drugbank.index.duplicated(keep='first')]
+
+
+def read_pharm_classes(fda_file):
+    """
+    :param fda_file: str, PubChem's 'FDA Pharm Classes' annotations JSON
+    :return: Pandas DataFrame, moa and drug_class by lowercase drug name
+    """
+    with open(fda_file, 'r') as f:
+        annotations = json.load(f)['Annotations']['Annotation']
+    rows = {}
+    for annotation in annotations:
+        row = {'moa': None, 'drug_class': None}
+        for data in annotation.get('Data', []):
+            strings = data.get('Value', {}).get('StringWithMarkup', [])
+            if not strings:
+                continue
+            if data.get('Name') == 'Mechanisms of Action [MoA]':
+                row['moa'] = strings[0]['String']
+            elif data.get('Name') == 'Established Pharmacologic Class [EPC]':
+                row['drug_class'] = strings[0]['String']
+        rows.setdefault(annotation['Name'].lower(), row)
+    return pd.DataFrame.from_dict(rows, orient='index', columns=['moa', 'drug_class'])
+
+
+def load_drug_index(drug_annotation_dir, discover_data_dir=None, cls=None, drugbank_file=None, fda_file=None,
+                    cache_file=None):
+    """
+    Build the DrugIndex once and pickle it to cache_file; later calls (in any process) load the pickle,
+    and within a process the same DrugIndex is returned. It is rebuilt when any source file changes:
+    a different size or mtime triggers a SHA-1 comparison, and a different hash a rebuild.
+    :param drug_annotation_dir: str, with drug_source_moa_annotations.xlsx and clinically_relevant_drugs.csv
+    :param discover_data_dir: str, optional, with one {cl}/{cl}_name_to_pubchem_cid.json per database
+    :param cls: list of databases in discover_data_dir, defaults to drug_index_cls
+    :param drugbank_file: str, optional, drugbank.tsv
+    :param fda_file: str, optional, FDA pharmacological classes JSON
+    :param cache_file: str, defaults to drug_index.pickle in drug_annotation_dir.
+        If it cannot be written to, the index is only kept in memory.
+    :return: DrugIndex
+    """
+    paths = [os.path.join(drug_annotation_dir, 'drug_source_moa_annotations.xlsx'),
+             os.path.join(drug_annotation_dir, 'clinically_relevant_drugs.csv')]
+    cl_files = []
+    if discover_data_dir is not None:
+        if cls is None:
+            cls = drug_index_cls
+        cl_files = [(cl, os.path.join(discover_data_dir, cl, '{}_name_to_pubchem_cid.json'.format(cl))) for cl in cls]
+    paths += [cl_file for _, cl_file in cl_files] + [path for path in [drugbank_file, fda_file] if path is not None]
+    sources = file_sources(paths)
+    if cache_file is None:
+        cache_file = os.path.join(drug_annotation_dir, 'drug_index.pickle')
+    key = os.path.abspath(cache_file)
+    if key in loaded_drug_indexes and same_sources(loaded_drug_indexes[key][0], sources):
+        return loaded_drug_indexes[key][1]
+    index = None
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['version'] == drug_index_version and same_sources(cached['sources'], sources):
+            index = cached['index']
+            for cached_source, source in zip(cached['sources'], sources):
+                source['sha1'] = cached_source['sha1']
+    if index is None:
+        rdrug_to_cids, rdrug_mechs = read_drug_annotations(drug_annotation_dir)
+        drug_to_cids = {}
+        for cl, cl_file in cl_files:
+            with open(cl_file, 'r') as f:
+                drug_to_cids.update({'{}_{}'.format(cl, drug): cids for drug, cids in json.load(f).items()})
+        index = DrugIndex(rdrug_to_cids, rdrug_mechs, drug_to_cids=drug_to_cids,
+                          drugbank=None if drugbank_file is None else read_drugbank(drugbank_file),
+                          pharm_classes=None if fda_file is None else read_pharm_classes(fda_file))
+        for source in sources:
+            source['sha1'] = file_sha1(source['path'])
+        try:
+            with open(cache_file, 'wb') as f:
+                pickle.dump({'version': drug_index_version, 'sources': sources, 'index': index}, f)
+        except OSError as e:
+            print('Could not write {}: {}'.format(cache_file, e))
+    loaded_drug_indexes[key] = (sources, index)
+    return index
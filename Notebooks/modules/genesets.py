@@ -1,9 +1,31 @@
 import os
+import sys
+import json
 import itertools
 from collections import defaultdict
+from collections.abc import Mapping
 
+import numpy as np
+import pandas as pd
+import scipy.sparse
 
-def load_genesets(genesets_dir, msigdb_version='6.1', which='all'):
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from modules.results_store import file_sources, same_sources, file_sha1
+
+store_magic = b'GENESETS3'
+loaded_geneset_stores = {}
+
+
+def load_genesets(genesets_dir, msigdb_version='6.1', which='all', compiled=False, cache_dir=None):
+    """
+    :param which: str or list of str, keys of the collections below. With a list, later collections
+        take precedence for set names found in more than one.
+    :param compiled: bool, if False parse the GMT files into a dict; if True return a read-only GenesetStore,
+        compiled from the GMT files once and memory-mapped afterwards (see load_geneset_store())
+    :param cache_dir: str, where load_geneset_store() keeps compiled stores
+    :return: GenesetStore or dict, set names to sets of genes
+    """
     msigdb_all_genesets_gmt = os.path.join(genesets_dir, 'msigdb.v{}.symbols.gmt'.format(msigdb_version))
     ipa_gmt = os.path.join(genesets_dir, 'IPA_regulators.gmt')
     myc_gmt = os.path.join(genesets_dir, 'MYC_signatures.gmt')
@@ -50,15 +72,194 @@ def load_genesets(genesets_dir, msigdb_version='6.1', which='all'):
                            'all': all_genesets_gmt
                       }
     geneset_names_string = ", ".join(arg_to_gmt_dict.keys())
-    if isinstance(which, str):
-        if which not in arg_to_gmt_dict:
-            raise ValueError("{} not a supported geneset; try one of {}".format(which, geneset_names_string))
-        p2g = read_gmt(arg_to_gmt_dict[which])
-        p2g = fix_synonyms(p2g)
-    elif type(which) is list:
-        all_items = [load_genesets(which=wh).items() for wh in which]
-        p2g = dict(itertools.chain(*all_items))
-    return p2g
+    whiches = [which] if isinstance(which, str) else which
+    for wh in whiches:
+        if wh not in arg_to_gmt_dict:
+            raise ValueError("{} not a supported geneset; try one of {}".format(wh, geneset_names_string))
+    gmt_files = [arg_to_gmt_dict[wh] for wh in whiches]
+    if compiled:
+        if cache_dir is None:
+            cache_dir = os.path.join(genesets_dir, 'store_cache')
+        store_file = os.path.join(cache_dir, '{}.v{}.genesets'.format('+'.join(whiches), msigdb_version))
+        return load_geneset_store(gmt_files, store_file)
+    return read_gmts(gmt_files)
+
+
+def read_gmts(gmt_files):
+    all_items = [fix_synonyms(read_gmt(gmt_file)).items() for gmt_file in gmt_files]
+    return dict(itertools.chain(*all_items))
+
+
+class GenesetStore(Mapping):
+    """
+    Gene sets as CSR arrays over a sorted gene vocabulary: the genes of set i are
+    genes[indices[indptr[i]:indptr[i + 1]]]. Read-only; behaves as a dict of set names to sets of genes.
+
+    Parameters
+    ----------
+    set_names : array of str, (n_sets,)
+    genes : array of str, (n_genes,), sorted
+    indptr : int array, (n_sets + 1,)
+    indices : int array, (indptr[-1],), sorted within each set
+    """
+
+    def __init__(self, set_names, genes, indptr, indices):
+        self.set_names = set_names
+        self.genes = genes
+        self.indptr = indptr
+        self.indices = indices
+        self._set_name_list = None
+        self._set_to_pos = None
+
+    @property
+    def set_name_list(self):
+        if self._set_name_list is None:
+            self._set_name_list = self.set_names.tolist()
+        return self._set_name_list
+
+    def __len__(self):
+        return len(self.set_names)
+
+    def __iter__(self):
+        return iter(self.set_name_list)
+
+    def __getitem__(self, set_name):
+        return set(self.genes[self.gene_indices(set_name)].tolist())
+
+    def gene_indices(self, set_name):
+        """
+        :return: int array, positions in self.genes of the genes of set_name
+        """
+        if self._set_to_pos is None:
+            self._set_to_pos = dict(zip(self.set_name_list, range(len(self))))
+        pos = self._set_to_pos[set_name]
+        return self.indices[self.indptr[pos]:self.indptr[pos + 1]]
+
+    def membership(self, genes):
+        """
+        Same as gsea.make_membership_matrix(genes, self), without going through Python sets.
+        :param genes: list-like of gene names, the columns of the expression matrix
+        :return: scipy.sparse.csr_matrix, (n_sets, len(genes)), list of set names
+        """
+        genes = pd.Index(genes)
+        # as with a dict, the last of repeated genes is the one used
+        last = ~genes.duplicated(keep='last')
+        positions = genes[last].get_indexer(self.genes)
+        vocab_to_col = np.where(positions >= 0, np.flatnonzero(last)[positions], -1)
+        cols = vocab_to_col[self.indices]
+        found = cols >= 0
+        set_ids = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(set_ids[found], minlength=len(self)))])
+        membership = scipy.sparse.csr_matrix((np.ones(found.sum()), cols[found], indptr),
+                                             shape=(len(self), len(genes)))
+        membership.sort_indices()
+        return membership, list(self.set_name_list)
+
+
+def compile_genesets(p2g):
+    """
+    :param p2g: dict of set names to sets of genes
+    :return: GenesetStore, without the sets that have no genes (as read_gmt() drops them)
+    """
+    set_names = [set_name for set_name, genes in p2g.items() if genes]
+    set_sizes = np.array([len(p2g[set_name]) for set_name in set_names], dtype=np.int64)
+    all_genes = list(itertools.chain(*[p2g[set_name] for set_name in set_names]))
+    codes, genes = pd.factorize(np.array(all_genes, dtype=object))
+    genes = np.array(genes, dtype=str)
+    order = np.argsort(genes)
+    genes = genes[order]
+    indices = np.argsort(order)[codes]
+    set_ids = np.repeat(np.arange(len(set_names)), set_sizes)
+    indices = indices[np.lexsort((indices, set_ids))].astype(np.int32)
+    indptr = np.concatenate([[0], np.cumsum(set_sizes)])
+    return GenesetStore(np.array(set_names, dtype=str), genes, indptr, indices)
+
+
+def write_geneset_store(store, store_file, sources):
+    """
+    One file: store_magic, the length of a JSON header, the header (sources, and the dtype, shape
+    and offset of each array), then the arrays, each aligned to 64 bytes so they can be memory-mapped.
+    """
+    arrays = [('set_names', store.set_names), ('genes', store.genes), ('indptr', store.indptr),
+              ('indices', store.indices)]
+    header = {'sources': sources, 'arrays': {}}
+    offset = 0
+    for name, array in arrays:
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // 64) * 64
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(store_magic) + 8 + len(header_bytes)) // 64) * 64
+    store_dir = os.path.dirname(store_file)
+    if store_dir and not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    # written under another name and then moved, so an interrupted write leaves no valid store
+    tmp_file = store_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(store_magic)
+        f.write(np.int64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in arrays:
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_file, store_file)
+
+
+def read_geneset_store(store_file):
+    """
+    :return: GenesetStore with memory-mapped arrays, list of the sources it was compiled from
+    """
+    with open(store_file, 'rb') as f:
+        if f.read(len(store_magic)) != store_magic:
+            raise ValueError("{} is not a geneset store".format(store_file))
+        header_length = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+        header = json.loads(f.read(header_length).decode())
+    data_start = -(-(len(store_magic) + 8 + header_length) // 64) * 64
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        if np.prod(spec['shape']) == 0:
+            arrays[name] = np.empty(spec['shape'], dtype=spec['dtype'])
+        else:
+            arrays[name] = np.memmap(store_file, dtype=spec['dtype'], mode='r',
+                                     offset=data_start + spec['offset'], shape=tuple(spec['shape']))
+    return GenesetStore(**arrays), header['sources']
+
+
+def load_geneset_store(gmt_files, store_file):
+    """
+    Compile gmt_files into store_file once, then memory-map it on later calls (also cached in memory).
+    The store is rebuilt when any GMT file changes: a different size or mtime triggers a SHA-1
+    comparison, and a different hash a rebuild.
+    :param gmt_files: list of str, later files take precedence for set names found in more than one
+    :param store_file: str. If it cannot be written to, the compiled store is only kept in memory.
+    :return: GenesetStore
+    """
+    sources = file_sources(gmt_files)
+    key = os.path.abspath(store_file)
+    if key in loaded_geneset_stores and same_sources(loaded_geneset_stores[key][0], sources):
+        return loaded_geneset_stores[key][1]
+    store = None
+    if os.path.exists(store_file):
+        try:
+            store, cached_sources = read_geneset_store(store_file)
+        except ValueError:  # written by an older version of this module
+            store, cached_sources = None, []
+        if same_sources(cached_sources, sources):
+            for cached, source in zip(cached_sources, sources):
+                source['sha1'] = cached['sha1']
+        else:
+            store = None
+    if store is None:
+        store = compile_genesets(read_gmts(gmt_files))
+        for source in sources:
+            source['sha1'] = file_sha1(source['path'])
+        try:
+            write_geneset_store(store, store_file, sources)
+            store, _ = read_geneset_store(store_file)
+        except OSError as e:
+            print('Could not write {}: {}'.format(store_file, e))
+    loaded_geneset_stores[key] = (sources, store)
+    return store
 
 
 def fix_synonyms(p2g, take='both'):
@@ -99,6 +300,6 @@ def read_gmt(gmt_file):
         entries = line.strip().split("\t")
         pathway_name = entries[0]
         genes = set(entries[2:])
-        if len(genes) > 0:
+        if genes:
             p2g[pathway_name] = genes
     return p2g
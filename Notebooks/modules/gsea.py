@@ -3,8 +3,12 @@ import itertools
 
 import numpy as np
 import pandas as pd
+import scipy.sparse
 from joblib import Parallel, delayed
 
+# number of expression values below which ssgsea_batch() is not worth splitting across threads
+ssgsea_parallel_min_size = 2 * 10 ** 6
+
 
 def consecutive_pairs(iterable):
     "s -> (s0,s1), (s1,s2), (s2, s3), ..."
@@ -13,15 +17,23 @@ def consecutive_pairs(iterable):
     return zip(a, b)
 
 
+def max_deviation(x):
+    """
+    collect_func for classic GSEA: the value of x furthest from zero
+    """
+    return x[np.argmax(np.abs(x))]
+
+
 def _base_gsea(ranked_genes, sets_to_genes, collect_func, alpha=0.75):
     """
     Basic idea:
     -make weighted ecdf for hits
     -make ecdf for misses
     -take elementwise difference
-    -collect_func() to get result (max_abs() for gsea, np.sum() for ssgsea)
+    -collect_func() to get result (max_deviation() for gsea, np.sum() for ssgsea)
 
-    Might still be able to speed up using array funcs rather than iterating?
+    For ssGSEA over many samples, _batch_ssgsea() computes the same scores without iterating;
+    for GSEA over many permutations, _batch_gsea() does.
     """
     n_genes = len(ranked_genes)
     ranks = list(range(n_genes))
@@ -35,7 +47,7 @@ def _base_gsea(ranked_genes, sets_to_genes, collect_func, alpha=0.75):
         misses[hit_ranks] = 0
         cum_misses = np.cumsum(misses)
         miss_ecdf = cum_misses / n_non_set_genes
-        cum_hits = np.zeros_like(ranks)
+        cum_hits = np.zeros(n_genes)  # float, so the weighted cumulative sums are not truncated
         if len(hit_ranks) > 0:
             cum_hit_sum = 0
             sorted_hit_ranks = sorted(hit_ranks)
@@ -57,31 +69,359 @@ def _base_gsea(ranked_genes, sets_to_genes, collect_func, alpha=0.75):
     return pd.Series(enrichment_scores)
 
 
-def ssgsea(exp_data, sets_to_genes, alpha=0.75, n_jobs=-1):
+def make_membership_matrix(genes, sets_to_genes):
+    """
+    Sparse (n_sets, n_genes) 0/1 matrix of set membership. Set genes not in genes are dropped.
+    :param genes: list-like of gene names, the columns of the expression matrix
+    :param sets_to_genes: dictionary with set names as keys and sets of genes as values,
+        or a genesets.GenesetStore, which maps its integer gene indices directly
+    :return: scipy.sparse.csr_matrix, list of set names
+    """
+    if hasattr(sets_to_genes, 'membership'):
+        return sets_to_genes.membership(genes)
+    gene_to_idx = dict(zip(genes, range(len(genes))))
+    set_names = list(sets_to_genes.keys())
+    indptr = [0]
+    indices = []
+    for set_name in set_names:
+        set_idxs = sorted({gene_to_idx[gene] for gene in sets_to_genes[set_name] if gene in gene_to_idx})
+        indices.extend(set_idxs)
+        indptr.append(len(indices))
+    data = np.ones(len(indices))
+    membership = scipy.sparse.csr_matrix((data, np.array(indices, dtype=int), np.array(indptr, dtype=int)),
+                                         shape=(len(set_names), len(genes)))
+    return membership, set_names
+
+
+def rank_genes(values):
+    """
+    :param values: array, (n_samples, n_genes)
+    :return: int32 array, (n_samples, n_genes), 0-based position of each gene when sorted in
+        descending order, NaNs last, as with pd.Series.sort_values(ascending=False)
+    """
+    n_samples, n_genes = values.shape
+    order = np.argsort(-values, axis=1, kind='stable')
+    ranks = np.empty((n_samples, n_genes), dtype=np.int32)
+    ranks[np.arange(n_samples)[:, np.newaxis], order] = np.arange(n_genes, dtype=np.int32)
+    return ranks
+
+
+def _batch_ssgsea(ranks, membership, alpha=0.75):
+    """
+    ssGSEA for all samples and sets at once.
+
+    Summing a running ECDF over all positions counts each step once per remaining position,
+    so sum(cumsum(v)) == dot(v, n - rank). The per-set loops of _base_gsea then reduce to
+    three sparse matrix products against rank-derived weights.
+
+    :param ranks: array, (n_samples, n_genes), from rank_genes()
+    :param membership: scipy.sparse matrix, (n_sets, n_genes), e.g. from make_membership_matrix()
+    :param alpha: float, weighting factor between zero and one
+    :return: array, (n_samples, n_sets), not yet normalized by the maximum possible score
+    """
+    n_genes = ranks.shape[1]
+    ranks = ranks.astype(float)
+    positions_left = n_genes - ranks
+    weights = (ranks + 1) ** alpha
+    hit_weight_sums = membership.dot(weights.T)
+    hit_sums = membership.dot((weights * positions_left).T)
+    hit_positions_left = membership.dot(positions_left.T)
+    set_sizes = np.asarray(membership.sum(axis=1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hit_terms = np.where(hit_weight_sums > 0, hit_sums / hit_weight_sums, 0)
+        miss_terms = (0.5 * n_genes * (n_genes + 1) - hit_positions_left) / (n_genes - set_sizes)
+    return (hit_terms - miss_terms).T
+
+
+def ssgsea_batch(exp_data, sets_to_genes, alpha=0.75, membership=None, chunk_size=256, ranks=None, n_jobs=1,
+                 backend='auto'):
+    """
+    Vectorized ssGSEA, equivalent to ssgsea_per_sample() applied to every sample.
+    Ties in expression may be ordered differently; otherwise scores agree to floating-point tolerance.
+    Every set gets a column; sets with no genes in exp_data score -(n_genes + 1) / n_genes, as in the loop.
+    :param exp_data: Pandas DataFrame of expression values, (n_samples, n_genes)
+    :param sets_to_genes: dictionary with set names as keys and sets of genes as values, e.g. {'set1': {'g1', 'g2'}}
+    :param alpha: float, weighting factor between zero and one.
+    :param membership: optional (scipy.sparse matrix, set names) tuple matching exp_data.columns,
+        to reuse the output of make_membership_matrix() across calls
+    :param chunk_size: int, number of samples scored per block, to bound memory
+    :param ranks: optional array, rank_genes(exp_data.values), to reuse the sorting of exp_data across calls
+    :param n_jobs: int, number of blocks scored at once; -1 for one per CPU
+    :param backend: 'auto' (see choose_ssgsea_backend()), 'threading', 'loky' or 'multiprocessing'
+    :return: Pandas DataFrame, (n_samples, n_sets)
+    """
+    if membership is None:
+        membership = make_membership_matrix(exp_data.columns, sets_to_genes)
+    membership, set_names = membership
+    n_samples, n_genes = exp_data.shape
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if backend == 'auto':
+        backend = choose_ssgsea_backend('batch', n_samples, n_genes, n_jobs, chunk_size)
+    blocks = [(start, min(start + chunk_size, n_samples)) for start in range(0, n_samples, chunk_size)]
+    if ranks is None:
+        values = exp_data.values
+        block_inputs = [(values[start:stop], None) for start, stop in blocks]
+    else:
+        block_inputs = [(None, ranks[start:stop]) for start, stop in blocks]
+    if backend is None:
+        block_scores = [ssgsea_block(values, block_ranks, membership, alpha) for values, block_ranks in block_inputs]
+    else:
+        # membership is sent once per block; for processes, joblib memory-maps the large arrays
+        block_scores = Parallel(n_jobs=n_jobs, backend=backend)(
+            delayed(ssgsea_block)(values, block_ranks, membership, alpha) for values, block_ranks in block_inputs)
+    scores = np.concatenate(block_scores) if block_scores else np.empty((0, len(set_names)))
+    scores /= 0.5 * n_genes  # maximum possible score
+    return pd.DataFrame(scores, index=exp_data.index, columns=set_names)
+
+
+def ssgsea_block(values, ranks, membership, alpha):
+    if ranks is None:
+        ranks = rank_genes(values.astype(float))
+    return _batch_ssgsea(ranks, membership, alpha=alpha)
+
+
+def choose_ssgsea_backend(method, n_samples, n_genes, n_jobs, chunk_size=256):
+    """
+    The batch engine spends its time in NumPy sorting and scipy.sparse products, which release the GIL,
+    so threads share the data for free. The loop engine is pure Python and needs processes.
+    Matrices too small to split, or too small to amortize starting processes, are scored serially.
+    :return: 'threading', 'loky' or None for serial
+    """
+    if n_jobs == 1:
+        return None
+    if method == 'batch':
+        if n_samples <= chunk_size or n_samples * n_genes < ssgsea_parallel_min_size:
+            return None
+        return 'threading'
+    if n_samples < 2 * n_jobs:
+        return None
+    return 'loky'
+
+
+def ssgsea(exp_data, sets_to_genes, alpha=0.75, n_jobs=-1, method='batch', ranks=None, backend='auto'):
     """
     Single-sample GSEA as described in Barbie et al. (2009)
     :param exp_df: Pandas DataFrame or Series of expression values, (n_samples, n_genes) or (n_genes,)
     :param sets_to_genes: dictionary with set names as keys and sets of genes as values, e.g. {'set1': {'g1', 'g2'}}
     :param alpha: float, weighting factor between zero and one.
         Smaller values give more weight to top/bottom of list.
-    :return: Pandas DataFrame or Series of expression projected onto gene sets
+    :param n_jobs: int, number of threads or processes; -1 for one per CPU
+    :param method: 'batch' (vectorized, see ssgsea_batch()) or 'loop' (one _base_gsea() call per sample)
+    :param ranks: optional array, rank_genes(exp_data.values), for method='batch' on a DataFrame
+    :param backend: 'auto' (see choose_ssgsea_backend()), 'threading', 'loky' or 'multiprocessing'
+    :return: Pandas DataFrame or Series of expression projected onto gene sets, one column per set with either method;
+        sets with no genes in exp_data score -(n_genes + 1) / n_genes
     """
+    if method not in ['batch', 'loop']:
+        raise ValueError("{} is not a supported method. Try 'batch' or 'loop'".format(method))
     if isinstance(exp_data, pd.Series):
+        if method == 'batch':
+            return ssgsea_batch(exp_data.to_frame().T, sets_to_genes, alpha=alpha).iloc[0]
         return ssgsea_per_sample(exp_data, sets_to_genes, alpha=alpha)
     elif isinstance(exp_data, pd.DataFrame):
+        if method == 'batch':
+            return ssgsea_batch(exp_data, sets_to_genes, alpha=alpha, ranks=ranks, n_jobs=n_jobs, backend=backend)
         if n_jobs == -1:
             n_jobs = os.cpu_count()
-        ssgsea_inputs = [(exp_data.loc[sample], sets_to_genes, alpha) for sample in exp_data.index]
-        ssgseas = Parallel(n_jobs=n_jobs)(delayed(ssgsea_per_sample)(*inputs) for inputs in ssgsea_inputs)
-        return pd.concat(ssgseas, axis=1).T
+        if backend == 'auto':
+            backend = choose_ssgsea_backend('loop', exp_data.shape[0], exp_data.shape[1], n_jobs)
+        if backend is None:
+            return ssgsea_per_block(exp_data, sets_to_genes, alpha)
+        # one block per worker, so sets_to_genes is pickled n_jobs times rather than once per sample
+        blocks = np.array_split(np.arange(exp_data.shape[0]), n_jobs)
+        ssgseas = Parallel(n_jobs=n_jobs, backend=backend)(
+            delayed(ssgsea_per_block)(exp_data.iloc[block], sets_to_genes, alpha) for block in blocks if len(block))
+        return pd.concat(ssgseas)
         #return exp_data.apply(ssgsea_per_sample, axis=1, args=(sets_to_genes, alpha))
     else:
         raise ValueError("exp_data must be Pandas DataFrame or Series")
 
 
+def ssgsea_per_block(exp_df, sets_to_genes, alpha):
+    return pd.concat([ssgsea_per_sample(exp_df.iloc[i], sets_to_genes, alpha) for i in range(exp_df.shape[0])],
+                     axis=1).T
+
+
 def ssgsea_per_sample(exp_series, sets_to_genes, alpha):
     sorted_exp_series = exp_series.sort_values(ascending=False)
     enrichment_scores = _base_gsea(sorted_exp_series.index, sets_to_genes, collect_func=np.sum, alpha=alpha)
     enrichment_scores /= 0.5 * len(exp_series)  # maximum possible score
     enrichment_scores.name = exp_series.name
-    return enrichment_scores
\ No newline at end of file
+    return enrichment_scores
+
+
+gsea_metrics = ['signal_to_noise', 'difference_of_means']
+gsea_permutation_types = ['phenotype', 'gene_set']
+
+
+def _batch_gsea(positions, weights, n_genes):
+    """
+    Classic (max deviation) enrichment scores of one gene set in many ranked lists at once.
+
+    Between hits the running sum only decreases, so its maximum is reached at a hit and its
+    minimum just before one: the ECDFs only need evaluating at the set's k hits rather than
+    at all n_genes positions. Equivalent to _base_gsea(collect_func=max_deviation) per row.
+
+    :param positions: int array, (n_lists, k), 0-based position of each set gene in each ranked list
+    :param weights: array, (n_lists, k), weight of each set gene in each list
+    :param n_genes: int, length of the ranked lists
+    :return: array, (n_lists,)
+    """
+    n_hits = positions.shape[1]
+    order = np.argsort(positions, axis=1)
+    positions = np.take_along_axis(positions, order, axis=1)
+    weights = np.take_along_axis(weights, order, axis=1)
+    cum_weights = np.cumsum(weights, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hit_ecdf = cum_weights / cum_weights[:, -1:]
+        pre_hit_ecdf = hit_ecdf - weights / cum_weights[:, -1:]
+    # misses before (and at) the j-th hit
+    miss_ecdf = (positions - np.arange(n_hits)) / float(n_genes - n_hits)
+    top = np.max(hit_ecdf - miss_ecdf, axis=1)
+    bottom = np.min(pre_hit_ecdf - miss_ecdf, axis=1)
+    return np.where(np.abs(top) >= np.abs(bottom), top, bottom)
+
+
+def phenotype_statistics(values, labels, metric='signal_to_noise'):
+    """
+    :param values: array, (n_samples, n_genes)
+    :param labels: bool array, (n_labelings, n_samples), True for samples of the class of interest
+    :param metric: one of gsea_metrics. As in GSEA, signal_to_noise floors each standard deviation
+        at 0.2 * |mean| (0.2 for a mean of zero).
+    :return: array, (n_labelings, n_genes)
+    """
+    n_samples = values.shape[0]
+    labels = labels.astype(float)
+    n_a = labels.sum(axis=1)[:, np.newaxis]
+    n_b = n_samples - n_a
+    offsets = values.mean(axis=0)
+    centered = values - offsets  # keeps the sums of squares below well conditioned
+    sum_a = labels.dot(centered)
+    sum_b = centered.sum(axis=0) - sum_a
+    mean_a = sum_a / n_a
+    mean_b = sum_b / n_b
+    if metric == 'difference_of_means':
+        return mean_a - mean_b
+    squares = centered ** 2
+    sq_a = labels.dot(squares)
+    sq_b = squares.sum(axis=0) - sq_a
+    sd_a = np.sqrt(np.maximum(sq_a - n_a * mean_a ** 2, 0) / (n_a - 1))
+    sd_b = np.sqrt(np.maximum(sq_b - n_b * mean_b ** 2, 0) / (n_b - 1))
+    mean_a += offsets
+    mean_b += offsets
+    sd_a = np.maximum(sd_a, np.where(mean_a == 0, 0.2, 0.2 * np.abs(mean_a)))
+    sd_b = np.maximum(sd_b, np.where(mean_b == 0, 0.2, 0.2 * np.abs(mean_b)))
+    return (mean_a - mean_b) / (sd_a + sd_b)
+
+
+def gsea_significance(es, null_es):
+    """
+    Normalized enrichment scores, nominal p-values and FDR q-values as in Subramanian et al. (2005):
+    scores are divided by the mean of the null scores of the same sign, and the FDR of a NES compares
+    the fraction of null NES (of all sets) at least as extreme with the fraction of observed NES.
+    :param es: array, (n_sets,)
+    :param null_es: array, (n_sets, n_perms)
+    :return: nes, p_values, fdrs, arrays, (n_sets,)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        positive_null = null_es >= 0
+        negative_null = null_es < 0
+        mean_pos = np.sum(np.where(positive_null, null_es, 0), axis=1) / positive_null.sum(axis=1)
+        mean_neg = -np.sum(np.where(negative_null, null_es, 0), axis=1) / negative_null.sum(axis=1)
+        nes = es / np.where(es >= 0, mean_pos, mean_neg)
+        null_nes = null_es / np.where(positive_null, mean_pos[:, np.newaxis], mean_neg[:, np.newaxis])
+        n_same_sign = np.where(es >= 0, positive_null.sum(axis=1), negative_null.sum(axis=1))
+        n_as_extreme = np.where(es >= 0, (null_es >= es[:, np.newaxis]).sum(axis=1),
+                                (null_es <= es[:, np.newaxis]).sum(axis=1))
+        p_values = np.where(np.isnan(es), np.nan, n_as_extreme / n_same_sign)
+        fdrs = np.full(len(es), np.nan)
+        valid = ~np.isnan(nes)
+        for sign in [1, -1]:
+            # by symmetry, negative scores are handled as positive ones with the signs flipped
+            null_side = np.sort(sign * null_nes[(sign * null_nes >= 0) & ~np.isnan(null_nes)])
+            observed_side = np.sort(sign * nes[valid & (sign * nes >= 0)])
+            idxs = np.flatnonzero(valid & (sign * nes >= 0))
+            side_nes = sign * nes[idxs]
+            null_fraction = (len(null_side) - np.searchsorted(null_side, side_nes, side='left')) / len(null_side)
+            observed_fraction = (len(observed_side) - np.searchsorted(observed_side, side_nes, side='left')) / \
+                len(observed_side)
+            fdrs[idxs] = np.minimum(null_fraction / observed_fraction, 1)
+    return nes, p_values, fdrs
+
+
+def gsea(exp_data, sets_to_genes, phenotype=None, permutation_type='phenotype', metric='signal_to_noise', weight=1.,
+         n_perms=1000, batch_size=100, random_state=None):
+    """
+    Classic GSEA (Subramanian et al. 2005): max-deviation enrichment scores with a permutation null.
+
+    Permutations are scored in batches of batch_size: one rank matrix (batch_size, n_genes) per batch,
+    from which every set gathers the positions of its genes and is scored by _batch_gsea().
+    :param exp_data: Pandas DataFrame of expression values, (n_samples, n_genes), with phenotype;
+        or a Pandas Series of gene-level statistics (preranked), which allows permutation_type='gene_set' only
+    :param sets_to_genes: dictionary with set names as keys and sets of genes as values, or a GenesetStore
+    :param phenotype: array-like of bool, (n_samples,), True for samples of the class of interest
+    :param permutation_type: 'phenotype' (shuffle sample labels) or 'gene_set' (shuffle gene positions)
+    :param metric: one of gsea_metrics, used to rank genes by phenotype
+    :param weight: float, exponent of the |statistic| weights of hits; 0 gives the Kolmogorov-Smirnov statistic
+    :param n_perms: int
+    :param batch_size: int, permutations scored at a time, to bound memory
+    :param random_state: int, RandomState instance or None
+    :return: Pandas DataFrame, one row per set: size (genes found), es, nes, p_value, fdr
+    """
+    if permutation_type not in gsea_permutation_types:
+        raise ValueError("{} not a supported permutation_type; try one of {}".format(permutation_type,
+                                                                                  gsea_permutation_types))
+    if metric not in gsea_metrics:
+        raise ValueError("{} not a supported metric; try one of {}".format(metric, gsea_metrics))
+    if isinstance(random_state, np.random.RandomState):
+        rs = random_state
+    else:
+        rs = np.random.RandomState(seed=random_state)
+    if isinstance(exp_data, pd.Series):
+        if permutation_type != 'gene_set':
+            raise ValueError("preranked statistics (a Series) only support permutation_type='gene_set'")
+        genes = exp_data.index
+        statistics = exp_data.values.astype(float)[np.newaxis, :]
+    elif isinstance(exp_data, pd.DataFrame):
+        if phenotype is None:
+            raise ValueError("phenotype is required with an expression DataFrame")
+        labels = np.asarray(phenotype).astype(bool)
+        if len(labels) != exp_data.shape[0] or min(labels.sum(), (~labels).sum()) < 2:
+            raise ValueError("phenotype must label every sample, with at least two samples in each class")
+        genes = exp_data.columns
+        values = exp_data.values.astype(float)
+        statistics = phenotype_statistics(values, labels[np.newaxis, :], metric=metric)
+    else:
+        raise ValueError("exp_data must be Pandas DataFrame or Series")
+    membership, set_names = make_membership_matrix(genes, sets_to_genes)
+    set_idxs = [membership.indices[start:stop] for start, stop in consecutive_pairs(membership.indptr)]
+    n_genes = len(genes)
+    positions = rank_genes(statistics)[0]
+    es = np.full(len(set_names), np.nan)
+    for i, idxs in enumerate(set_idxs):
+        if 0 < len(idxs) < n_genes:
+            es[i] = _batch_gsea(positions[np.newaxis, idxs], np.abs(statistics[:, idxs]) ** weight, n_genes)[0]
+    sorted_weights = np.empty(n_genes)  # weight at each position of the observed ranking
+    sorted_weights[positions] = np.abs(statistics[0]) ** weight
+    null_es = np.full((len(set_names), n_perms), np.nan)
+    for start in range(0, n_perms, batch_size):
+        stop = min(start + batch_size, n_perms)
+        if permutation_type == 'phenotype':
+            perm_labels = labels[rs.random_sample((stop - start, len(labels))).argsort(axis=1)]
+            perm_statistics = phenotype_statistics(values, perm_labels, metric=metric)
+            perm_positions = rank_genes(perm_statistics)
+        else:
+            perm_positions = rs.random_sample((stop - start, n_genes)).argsort(axis=1)
+        for i, idxs in enumerate(set_idxs):
+            if np.isnan(es[i]):
+                continue
+            hit_positions = perm_positions[:, idxs]
+            if permutation_type == 'phenotype':
+                hit_weights = np.abs(perm_statistics[:, idxs]) ** weight
+            else:
+                hit_weights = sorted_weights[hit_positions]
+            null_es[i, start:stop] = _batch_gsea(hit_positions, hit_weights, n_genes)
+    nes, p_values, fdrs = gsea_significance(es, null_es)
+    sizes = np.diff(membership.indptr)
+    return pd.DataFrame({'size': sizes, 'es': es, 'nes': nes, 'p_value': p_values, 'fdr': fdrs}, index=set_names)
@@ -1,19 +1,31 @@
 """
-R's bandwidth selection seems to still be better and faster
- than any alternative we've found so far in Python.
+Bandwidths are selected by biased cross-validation, as R's MASS::bcv.
+bcv() reimplements it in NumPy for many variables at once; rbcv() calls R through rpy2
+and is kept to validate bcv() against (bandwidth_method='r').
 """
-import readline # not directly used, but avoids an import error in rpy2
+import hashlib
+
 import numpy as np
+from scipy.signal import fftconvolve
 from scipy.stats import pearsonr
 from statsmodels.nonparametric.kernel_density import KDEMultivariate
 
-import rpy2.robjects as ro
-from rpy2.robjects.numpy2ri import numpy2ri
+GOLDEN_SECTION = (3 - np.sqrt(5)) * 0.5
+BCV_DELMAX = 1000  # as DELMAX in MASS.c
+mass = None
 
-ro.conversion.py2ri = numpy2ri
-from rpy2.robjects.packages import importr
 
-mass = importr("MASS")
+def load_mass():
+    # rpy2 and R are only needed for bandwidth_method='r', so only import them then
+    global mass
+    if mass is None:
+        import readline # not directly used, but avoids an import error in rpy2
+        import rpy2.robjects as ro
+        from rpy2.robjects.numpy2ri import numpy2ri
+        ro.conversion.py2ri = numpy2ri
+        from rpy2.robjects.packages import importr
+        mass = importr("MASS")
+    return mass
 
 
 def rbcv(x):
@@ -21,28 +33,231 @@ def rbcv(x):
     :param x: array-like, (n_samples,)
     :return: float, bandwidth
     """
-    bandwidth = np.array(mass.bcv(x))[0]
+    bandwidth = np.array(load_mass().bcv(x))[0]
     #print("rbcv")
     return bandwidth
 
 
-def compute_bandwidth(x):
-    return rbcv(x) / 4  # scaling factor to make equivalent because different conventions are used
+def bin_pair_distances(X, nb):
+    """
+    For each column, the number of pairs of observations whose bins are k bins apart, as VR_den_bin in MASS.c.
+    Bins are counted once per column and autocorrelated with an FFT instead of looping over all pairs.
+    :param X: array, (n_samples, n_vars), NaNs are ignored
+    :return: d, array (n_vars,) of bin widths; cnt, array (n_vars, nb) of pair counts
+    """
+    n_vars = X.shape[1]
+    not_nan = ~np.isnan(X)
+    n = not_nan.sum(axis=0)
+    d = (np.nanmax(X, axis=0) - np.nanmin(X, axis=0)) * 1.01 / nb
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bins = np.trunc(X / d)  # C's (int) cast truncates toward zero
+    bins = np.nan_to_num(bins, nan=0, posinf=0, neginf=0).astype(int)
+    bins -= np.where(not_nan, bins, bins.max()).min(axis=0)
+    bins[~not_nan] = 0
+    n_bins = bins.max() + 1
+    hist = np.zeros((n_vars, n_bins))
+    np.add.at(hist, (np.tile(np.arange(n_vars), X.shape[0]), bins.ravel()), not_nan.ravel())
+    n_fft = 2 * n_bins
+    f = np.fft.rfft(hist, n=n_fft, axis=1)
+    autocorrelation = np.rint(np.fft.irfft(f * f.conj(), n=n_fft, axis=1)[:, :n_bins])
+    autocorrelation[:, 0] = (autocorrelation[:, 0] - n) / 2  # pairs within a bin, excluding self-pairs
+    cnt = np.zeros((n_vars, nb))
+    n_keep = min(nb, n_bins)
+    cnt[:, :n_keep] = autocorrelation[:, :n_keep]
+    return d, cnt
+
+
+def bcv_objective(h, n, d, cnt):
+    """
+    Biased cross-validation criterion, as VR_bcv_bin in MASS.c, for one bandwidth per variable.
+    :param h: array, (n_vars,)
+    """
+    hh = h / 4
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.square(np.arange(cnt.shape[1])[np.newaxis, :] * (d / hh)[:, np.newaxis])
+        term = np.exp(-delta / 4) * (delta * delta - 12 * delta + 12)
+        total = np.where(delta < BCV_DELMAX, term * cnt, 0).sum(axis=1)
+        return (1 + total / (32.0 * n)) / (2.0 * n * hh * np.sqrt(np.pi))
+
+
+def brent_fmin(f, lower, upper, tol):
+    """
+    R's optimize() (Brent_fmin in optimize.c), run in lockstep for arrays of independent intervals.
+    :param f: function mapping an array of points to an array of objective values
+    :param lower: array, (n_vars,)
+    :param upper: array, (n_vars,)
+    :param tol: array, (n_vars,)
+    :return: array, (n_vars,), the minima
+    """
+    eps = np.sqrt(np.finfo(float).eps)
+    a = lower.astype(float)
+    b = upper.astype(float)
+    x = a + GOLDEN_SECTION * (b - a)
+    v = x.copy()
+    w = x.copy()
+    d = np.zeros_like(x)
+    e = np.zeros_like(x)
+    fx = f(x)
+    fv = fx.copy()
+    fw = fx.copy()
+    tol3 = tol / 3
+    active = np.ones(x.shape, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        while True:
+            xm = (a + b) * 0.5
+            tol1 = eps * np.abs(x) + tol3
+            t2 = tol1 * 2
+            active &= ~(np.abs(x - xm) <= t2 - (b - a) * 0.5) & np.isfinite(x)
+            if not active.any():
+                break
+            # fit parabola
+            fit = np.abs(e) > tol1
+            r = (x - w) * (fx - fv)
+            q = (x - v) * (fx - fw)
+            p = (x - v) * q - (x - w) * r
+            q = (q - r) * 2
+            p = np.where(q > 0, -p, p)
+            q = np.abs(q)
+            p = np.where(fit, p, 0)
+            q = np.where(fit, q, 0)
+            r = np.where(fit, e, 0)
+            e = np.where(fit, d, e)
+            golden = (np.abs(p) >= np.abs(q * 0.5 * r)) | (p <= q * (a - x)) | (p >= q * (b - x))
+            # parabolic-interpolation step, not too close to the interval's ends
+            d_parabolic = p / q
+            u = x + d_parabolic
+            d_parabolic = np.where((u - a < t2) | (b - u < t2), np.where(x >= xm, -tol1, tol1), d_parabolic)
+            # golden-section step
+            e = np.where(golden, np.where(x < xm, b - x, a - x), e)
+            d = np.where(golden, GOLDEN_SECTION * e, d_parabolic)
+            # not too close to x
+            u = np.where(np.abs(d) >= tol1, x + d, np.where(d > 0, x + tol1, x - tol1))
+            fu = f(u)
+            better = fu <= fx
+            replace_w = (fu <= fw) | (w == x)
+            replace_v = ~replace_w & ((fu <= fv) | (v == x) | (v == w))
+            new_a = np.where(better, np.where(u < x, a, x), np.where(u < x, u, a))
+            new_b = np.where(better, np.where(u < x, x, b), np.where(u < x, b, u))
+            new_v = np.where(better, w, np.where(replace_w, w, np.where(replace_v, u, v)))
+            new_fv = np.where(better, fw, np.where(replace_w, fw, np.where(replace_v, fu, fv)))
+            new_w = np.where(better, x, np.where(replace_w, u, w))
+            new_fw = np.where(better, fx, np.where(replace_w, fu, fw))
+            new_x = np.where(better, u, x)
+            new_fx = np.where(better, fu, fx)
+            a, b, v, fv, w, fw, x, fx = [np.where(active, new, old) for new, old in
+                                         zip([new_a, new_b, new_v, new_fv, new_w, new_fw, new_x, new_fx],
+                                             [a, b, v, fv, w, fw, x, fx])]
+    return x
+
+
+def bcv(X, nb=1000):
+    """
+    Biased cross-validation bandwidths, as R's MASS::bcv, for every column of X at once.
+    NaNs are ignored column by column.
+    :param X: array-like, (n_samples,) or (n_samples, n_vars)
+    :param nb: int, number of bins
+    :return: float, or array (n_vars,), bandwidths. NaN for columns with fewer than 2 values.
+    """
+    X = np.array(X, dtype=float)
+    one_var = X.ndim == 1
+    if one_var:
+        X = X[:, np.newaxis]
+    bandwidths = np.full(X.shape[1], np.nan)
+    n = (~np.isnan(X)).sum(axis=0)
+    enough = n >= 2
+    if enough.any():
+        X = X[:, enough]
+        n = n[enough]
+        hmax = 1.144 * np.nanstd(X, axis=0, ddof=1) * n ** (-1 / 5) * 4
+        lower = 0.1 * hmax
+        d, cnt = bin_pair_distances(X, nb)
+        bandwidths[enough] = brent_fmin(lambda h: bcv_objective(h, n, d, cnt), lower, hmax, 0.1 * lower)
+    return bandwidths[0] if one_var else bandwidths
+
+
+def compute_bandwidth(x, bandwidth_method='numpy'):
+    return compute_bandwidths(np.array(x, dtype=float)[:, np.newaxis], bandwidth_method=bandwidth_method)[0]
+
+
+def compute_bandwidths(X, bandwidth_method='numpy'):
+    """
+    :param X: array, (n_samples, n_vars)
+    :param bandwidth_method: 'numpy' (bcv(), all columns at once) or 'r' (rbcv(), one column at a time)
+    :return: array, (n_vars,), bandwidths in the convention of KDEMultivariate
+    """
+    if bandwidth_method not in ['numpy', 'r']:
+        raise ValueError("{} is not a supported bandwidth method. Try 'numpy' or 'r'".format(bandwidth_method))
+    if bandwidth_method == 'r':
+        return np.array([rbcv(X[~np.isnan(X[:, i]), i]) for i in range(X.shape[1])]) / 4
+    return bcv(X) / 4  # scaling factor to make equivalent because different conventions are used
 
 
-def compute_unspecified_bandwidths(variables, bandwidths):
+def compute_unspecified_bandwidths(variables, bandwidths, bandwidth_method='numpy'):
     n_vars = len(variables)
     if bandwidths is None:
         bandwidths = [None] * len(variables)
-    delta = []
-    for i, bw in enumerate(bandwidths):
-        if bw is None:
-            bw = compute_bandwidth(variables[i])
-        delta.append(bw)
-    delta = np.array(delta).reshape((n_vars,))
+    delta = np.array([np.nan if bw is None else bw for bw in bandwidths], dtype=float)
+    unspecified = [i for i, bw in enumerate(bandwidths) if bw is None]
+    if len(unspecified) > 0:
+        X = np.column_stack([variables[i] for i in unspecified])
+        delta[unspecified] = compute_bandwidths(X, bandwidth_method=bandwidth_method)
+    delta = delta.reshape((n_vars,))
     return delta
 
 
+class BandwidthCache(object):
+    """
+    Bandwidths keyed by the values a variable has once NaNs are dropped, i.e. by column identity and NaN mask.
+
+    compute_discover_ics() pairs every disease signature with every drug, so without a cache
+    each drug's bandwidth is recomputed once per disease and each disease's once per drug NaN mask.
+    The cache is filled in batches, so all missing bandwidths are estimated in one compute_bandwidths() call.
+    Only the unscaled bandwidths are stored: grids and marginal entropies depend on the pair
+    (jitter, ic_bandwidth_scaling_and_sign()), so they are still computed per IC.
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of lookups served from the cache, and number that had to be estimated.
+    """
+
+    def __init__(self, bandwidth_method='numpy'):
+        self.bandwidth_method = bandwidth_method
+        self.bandwidths = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(values, mask):
+        return hashlib.sha1(np.ascontiguousarray(values[mask], dtype=float).tobytes()).hexdigest()
+
+    def get_bandwidths(self, variables):
+        """
+        :param variables: list of (values, mask) tuples; values is an array (n_samples,),
+            mask a boolean array (n_samples,) of the entries to use
+        :return: array, (len(variables),), bandwidths in the convention of KDEMultivariate
+        """
+        keys = [self.make_key(values, mask) for values, mask in variables]
+        missing = {}
+        for key, (values, mask) in zip(keys, variables):
+            if key in self.bandwidths or key in missing:
+                self.hits += 1
+            else:
+                self.misses += 1
+                missing[key] = np.where(mask, values, np.nan)
+        if len(missing) > 0:
+            X = np.column_stack(list(missing.values()))
+            self.bandwidths.update(zip(missing.keys(), compute_bandwidths(X, bandwidth_method=self.bandwidth_method)))
+        return np.array([self.bandwidths[key] for key in keys])
+
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.bandwidths),
+                'hit_rate': self.hits / n_lookups if n_lookups > 0 else 0}
+
+
 def keep_nonnan_overlap(variables):
     n = len(variables[0])
     non_nans = [np.logical_not(np.isnan(v)) for v in variables]
@@ -60,8 +275,95 @@ def add_jitter(variables, jitter_scale=1E-10):
     return variables
 
 
+def gaussian_kernels(v, grid, bandwidth):
+    """
+    :return: array, (n_grid, n_samples), Gaussian kernel of each sample evaluated at each grid point
+    """
+    u = (grid[:, np.newaxis] - v[np.newaxis, :]) / bandwidth
+    return np.exp(-0.5 * np.square(u)) / (np.sqrt(2 * np.pi) * bandwidth)
+
+
+def meshgrid_order(n_vars):
+    # np.meshgrid's default 'xy' indexing puts the second variable on the first axis
+    order = list(range(n_vars))
+    if n_vars > 1:
+        order[0], order[1] = 1, 0
+    return order
+
+
+def gaussian_sum_density(variables, grids, bandwidths):
+    """
+    Exact product-Gaussian KDE, as KDEMultivariate with continuous variables, evaluated on np.meshgrid(*grids).
+    The kernel is separable, so the sum over samples is one einsum over per-variable kernel matrices.
+    :return: array, (n_grid,) * n_vars, in the layout of kde.pdf(grid).reshape(grid_shape)
+    """
+    kernels = [gaussian_kernels(v, grid, bw) for v, grid, bw in zip(variables, grids, bandwidths)]
+    letters = 'abcdefghijklmnopqr'[:len(variables)]
+    out_letters = ''.join(letters[i] for i in meshgrid_order(len(variables)))
+    subscripts = ','.join('{}z'.format(letter) for letter in letters) + '->' + out_letters
+    return np.einsum(subscripts, *kernels, optimize=True) / len(variables[0])
+
+
+def binned_fft_density(variables, grids, bandwidths):
+    """
+    Linear-binning KDE: samples are split between their two neighboring grid points along each axis,
+    then the binned counts are convolved with the Gaussian kernel sampled at the grid spacing (via FFT).
+    Approximate, but the cost no longer grows with n_samples * n_grid ** n_vars.
+    :return: array, (n_grid,) * n_vars, in the layout of kde.pdf(grid).reshape(grid_shape)
+    """
+    n_vars = len(variables)
+    n_samples = len(variables[0])
+    shape = tuple(len(grid) for grid in grids)
+    lower_idxs = []
+    fracs = []
+    for v, grid in zip(variables, grids):
+        d = grid[1] - grid[0]
+        t = (v - grid[0]) / d
+        lower = np.clip(np.floor(t).astype(int), 0, len(grid) - 2)
+        lower_idxs.append(lower)
+        fracs.append(np.clip(t - lower, 0, 1))
+    counts = np.zeros(shape)
+    for corner in np.ndindex(*([2] * n_vars)):
+        idxs = tuple(lower + c for lower, c in zip(lower_idxs, corner))
+        weights = np.prod([frac if c else 1 - frac for frac, c in zip(fracs, corner)], axis=0)
+        np.add.at(counts, idxs, weights)
+    kernel = np.ones([1] * n_vars)
+    for axis, (grid, bw) in enumerate(zip(grids, bandwidths)):
+        n = len(grid)
+        offsets = np.arange(-(n - 1), n) * (grid[1] - grid[0])
+        kernel_shape = [1] * n_vars
+        kernel_shape[axis] = 2 * n - 1
+        kernel = kernel * gaussian_kernels(offsets, np.zeros(1), bw).reshape(kernel_shape)
+    density = fftconvolve(counts, kernel, mode='same').clip(min=0) / n_samples
+    return np.transpose(density, meshgrid_order(n_vars))
+
+
+def kde_multivariate_density(variables, grids, bandwidths, var_types):
+    mesh_grids = np.meshgrid(*grids)
+    grid_shape = tuple(len(grid) for grid in grids)
+    grid = np.vstack([mesh_grid.flatten() for mesh_grid in mesh_grids])
+    kde = KDEMultivariate(variables, bw=bandwidths, var_type=var_types)
+    return kde.pdf(grid).reshape(grid_shape)
+
+
+density_backends = ['gaussian_sum', 'binned_fft', 'kde_multivariate']
+
+
+def compute_density(variables, grids, bandwidths, var_types, density='gaussian_sum'):
+    if density not in density_backends:
+        raise ValueError("{} is not a supported density backend; try one of {}".format(density, density_backends))
+    if density == 'kde_multivariate':
+        return kde_multivariate_density(variables, grids, bandwidths, var_types)
+    if set(var_types) != {'c'}:
+        raise ValueError("density backend {} only supports continuous ('c') variables".format(density))
+    if density == 'gaussian_sum':
+        return gaussian_sum_density(variables, grids, bandwidths)
+    return binned_fft_density(variables, grids, bandwidths)
+
+
 def compute_mutual_information(x, y, z=None, n_grid=25, var_types=None,
-                               bandwidth_scaling=None, bandwidths=None):
+                               bandwidth_scaling=None, bandwidths=None, density='gaussian_sum',
+                               bandwidth_method='numpy'):
     """
     :param x: array-like, (n_samples,)
     :param y: array-like, (n_samples,)
@@ -69,6 +371,13 @@ def compute_mutual_information(x, y, z=None, n_grid=25, var_types=None,
     :param n_grid: int, number of grid points at which to evaluate kernel density
     :param var_types: three-character string of 'c' (continuous), 'u' (unordered discrete) or 'o' (ordered discrete)
     :param bandwidth_scaling: float
+    :param bandwidths: list of floats or None, one per variable; None ones are estimated with bandwidth_method
+    :param bandwidth_method: 'numpy' (default) or 'r', see compute_bandwidths()
+    :param density: str, how the joint density is evaluated on the grid:
+        'gaussian_sum' (default): exact vectorized Gaussian sum; matches 'kde_multivariate' to ~1E-12
+        'binned_fft': linear binning + FFT convolution; ICs typically within ~5E-2 of 'kde_multivariate',
+            closer when bandwidths are large relative to the grid spacing
+        'kde_multivariate': statsmodels KDEMultivariate, the original implementation; needed for discrete var_types
     :return: float, information coefficient
     """
     n = len(x)
@@ -92,14 +401,10 @@ def compute_mutual_information(x, y, z=None, n_grid=25, var_types=None,
         return 0
     variables = add_jitter(variables)
     grids = [np.linspace(v.min(), v.max(), n_grid) for v in variables]
-    mesh_grids = np.meshgrid(*grids)
-    grid_shape = tuple([n_grid] * n_vars)
-    grid = np.vstack([mesh_grid.flatten() for mesh_grid in mesh_grids])
-    delta = compute_unspecified_bandwidths(variables, bandwidths)
+    delta = compute_unspecified_bandwidths(variables, bandwidths, bandwidth_method=bandwidth_method)
     if bandwidth_scaling is not None:
         delta *= bandwidth_scaling
-    kde = KDEMultivariate(variables, bw=delta, var_type=var_types)
-    p_joint = kde.pdf(grid).reshape(grid_shape) + np.finfo(float).eps  # THIS IS THE HOT SPOT. Get faster method
+    p_joint = compute_density(variables, grids, delta, var_types, density=density) + np.finfo(float).eps
     ds = [grid[1] - grid[0] for grid in grids]
     ds_prod = np.prod(ds)
     p_joint /= (p_joint.sum() * ds_prod)
@@ -127,13 +432,16 @@ def compute_mutual_information(x, y, z=None, n_grid=25, var_types=None,
         return cmi
 
 
-def compute_ic(x, y, z=None, n_grid=25, var_types=None, bandwidths=None, raise_errors=False):
+def compute_ic(x, y, z=None, n_grid=25, var_types=None, bandwidths=None, raise_errors=False, density='gaussian_sum',
+               bandwidth_method='numpy'):
     """
     :param x: array-like, (n_samples,)
     :param y: array-like, (n_samples,)
     :param z: array-like, (n_samples,), optional, variable on which to condition
     :param n_grid: int, number of grid points at which to evaluate kernel density
     :param var_types: three-character string of 'c' (continuous), 'u' (unordered discrete) or 'o' (ordered discrete)
+    :param density: str, density backend, see compute_mutual_information()
+    :param bandwidth_method: 'numpy' or 'r', see compute_bandwidths()
     """
     try:
         variables = [x, y]
@@ -145,7 +453,8 @@ def compute_ic(x, y, z=None, n_grid=25, var_types=None, bandwidths=None, raise_e
         bandwidth_scaling, ic_sign = ic_bandwidth_scaling_and_sign(x, y)
         mi = compute_mutual_information(x, y, z=z, n_grid=n_grid,
                                         var_types=var_types, bandwidths=bandwidths,
-                                        bandwidth_scaling=bandwidth_scaling)
+                                        bandwidth_scaling=bandwidth_scaling, density=density,
+                                        bandwidth_method=bandwidth_method)
         ic = ic_sign * np.sqrt(1 - np.exp(- 2 * mi))
     except Exception as e:
         print(e)
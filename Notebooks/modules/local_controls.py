@@ -9,7 +9,17 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardi
 from modules.utils import reduce_to_common_idxs, rank_normalize
 
 def make_dx_disease_gdict(exp_df, control_exp_df, n_genes=150, up=True, method='rankdif', valid_genes=None, sets=True):
-    disease_gdict = {}
+    return make_dx_disease_gdicts(exp_df, control_exp_df, n_genes=n_genes, up=(up,), method=method,
+                                  valid_genes=valid_genes, sets=sets)[0]
+
+
+def make_dx_disease_gdicts(exp_df, control_exp_df, n_genes=150, up=(True, False), method='rankdif', valid_genes=None,
+                           sets=True):
+    """
+    make_dx_disease_gdict() for several directions, from one computation of the rank differences (or log fold changes)
+    :param up: tuple of bool, the direction of each gdict to return
+    :return: tuple of dicts, sample name to the top n_genes genes (list, or set if sets), one per entry of up
+    """
     control_exp_olap, exp_olap = reduce_to_common_idxs([control_exp_df, exp_df])
     if method == 'rankdif':
         control_ranks, ranks = [rank_normalize(df) for df in [control_exp_olap, exp_olap]]
@@ -20,21 +30,43 @@ def make_dx_disease_gdict(exp_df, control_exp_df, n_genes=150, up=True, method='
     else:
         raise ValueError('method "{}" not supported; try one of ["rankdif", "logfold"]'.format(method))
     if valid_genes is None:
-        valid_genes_in_exp = exp_olap.columns.tolist()
+        valid_genes_in_exp = exp_olap.columns.values
     else:
-        valid_genes_in_exp = []
-        for g in exp_olap.columns:
-            for subg in g.split(' /// '):
-                if subg in valid_genes:
-                    valid_genes_in_exp.append(subg)
-                    break
-    for sample in exp_df.index:
-        topn = rankby_df.loc[sample, valid_genes_in_exp].sort_values(ascending=False if up else True).head(n_genes).index.tolist()
-        if sets:
-            topn = set(topn)
-        disease_gdict[sample] = topn
-
-    return disease_gdict
+        # first ' /// ' synonym of each gene that is a valid gene
+        synonyms = pd.Series(exp_olap.columns, dtype=object).str.split(' /// ').explode()
+        synonyms = synonyms[synonyms.isin(valid_genes)]
+        valid_genes_in_exp = synonyms[~synonyms.index.duplicated(keep='first')].values.astype(object)
+    positions = rankby_df.columns.get_indexer(valid_genes_in_exp)
+    values = rankby_df.loc[exp_df.index].values.astype(float)[:, positions]
+    values[:, positions < 0] = np.nan  # synonyms that are not genes of their own
+    gdicts = []
+    for direction in up:
+        topns = top_genes(values, valid_genes_in_exp, n_genes, up=direction)
+        gdicts.append({sample: set(topn) if sets else topn for sample, topn in zip(exp_df.index, topns)})
+    return tuple(gdicts)
+
+
+def top_genes(values, genes, n_genes, up=True):
+    """
+    :param values: NumPy array, (n_samples, len(genes))
+    :param genes: NumPy array of gene names, one per column of values
+    :param up: bool, whether to take the largest values (else the smallest)
+    :return: list of lists, the n_genes genes of each row sorted by value; NaNs last and ties in column order
+    """
+    keys = -values if up else values
+    n = min(n_genes, keys.shape[1])
+    if n == 0:
+        return [[] for _ in range(keys.shape[0])]
+    # n-th smallest key of each row; argpartition and argsort put NaNs last
+    kth = np.take_along_axis(keys, np.argpartition(keys, n - 1, axis=1)[:, n - 1:n], axis=1)
+    missing_kth = np.isnan(kth)
+    below = (keys < kth) | (missing_kth & ~np.isnan(keys))
+    at = (keys == kth) | (missing_kth & np.isnan(keys))
+    # break ties at the n-th key by column order
+    chosen = below | (at & (np.cumsum(at, axis=1) <= n - below.sum(axis=1, keepdims=True)))
+    top = np.nonzero(chosen)[1].reshape(keys.shape[0], n)
+    top = np.take_along_axis(top, np.argsort(np.take_along_axis(keys, top, axis=1), axis=1, kind='stable'), axis=1)
+    return genes[top].tolist()
 
 
 def load_control_exp(exp_drug_suggestion_controls_dir, control='neural_stem'):
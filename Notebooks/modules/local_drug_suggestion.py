@@ -1,43 +1,65 @@
 import os
 import sys
-from collections import defaultdict, Counter
 
 import numpy as np
 import pandas as pd
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
 
-from modules.utils import merge_redundant_series, expand_cols_to_synonymns, all_unique_values
-
-
-def to_cdfs_df(df, pad=1):
-    vals = df.values.ravel()
-    cdfs = to_cdfs(vals, pad=pad).reshape(df.shape)
+from modules.utils import merge_redundant_series, expand_cols_to_synonymns, rank_rows
+from modules.drug_index import load_drug_index
+
+
+def to_cdfs_df(df, pad=1, axis=None):
+    """
+    :param axis: None for one CDF over all values, 0 for one per column, 1 for one per row
+    """
+    vals = df.values.astype(float)
+    if axis is None:
+        cdfs = to_cdfs(vals.ravel(), pad=pad).reshape(df.shape)
+    elif axis == 0:
+        cdfs = to_cdfs_rows(vals.T, pad=pad).T
+    elif axis == 1:
+        cdfs = to_cdfs_rows(vals, pad=pad)
+    else:
+        raise ValueError("{} not a supported axis; try one of {}".format(axis, [None, 0, 1]))
     cdf_df = pd.DataFrame(cdfs, index=df.index, columns=df.columns)
     return cdf_df
 
 
 def to_cdfs(x, pad=1):
-    a = np.array(x)
-    nonnan = a[~np.isnan(a)]
-    n_nonnan = len(nonnan)
-    val2idxs = defaultdict(list)
-    for i, val in enumerate(x):
-        val2idxs[val].append(i)
-    counts = Counter(nonnan)
-    cdfs = np.empty(len(x))
+    """
+    :param x: array-like, (n,)
+    :return: array, (n,), number of non-NaN values of x less than or equal to each value, over
+        (number of non-NaN values + pad); NaN for NaN
+    """
+    a = np.asarray(x, dtype=float)
+    nonnan = ~np.isnan(a)
+    _, inverse, counts = np.unique(a[nonnan], return_inverse=True, return_counts=True)
+    cdfs = np.empty(len(a))
     cdfs.fill(np.nan)
-    n_le = 0
-    for val in sorted(counts.keys()):
-        count = counts[val]
-        n_le += count
-        idxs = val2idxs[val]
-        cdfs[idxs] = n_le
-    return cdfs / (n_nonnan + pad)
-
-
-def log_oddsify(df, pad=1):
-    cdfs_df = to_cdfs_df(df, pad=pad)
+    cdfs[nonnan] = np.cumsum(counts)[inverse]
+    return cdfs / (nonnan.sum() + pad)
+
+
+def to_cdfs_rows(s, pad=1):
+    """
+    to_cdfs() of each row of s: the number of values less than or equal to a value is its 'max' rank,
+    as NaNs are ranked after all values.
+    :param s: array, (n, m)
+    :return: array, (n, m)
+    """
+    nonnan = ~np.isnan(s)
+    cdfs = rank_rows(s, method='max').astype(float)
+    cdfs[~nonnan] = np.nan
+    return cdfs / (nonnan.sum(axis=1)[:, np.newaxis] + pad)
+
+
+def log_oddsify(df, pad=1, axis=None):
+    """
+    :param axis: None to log-oddsify all values together, 0 for each column independently, 1 for each row
+    """
+    cdfs_df = to_cdfs_df(df, pad=pad, axis=axis)
     probs = cdfs_df.values
     log_odds_df = pd.DataFrame(np.log(np.divide(probs, 1 - probs)), index=df.index, columns=df.columns)
     return log_odds_df
@@ -82,64 +104,14 @@ def simplify_syn_index(syn_index):
     return new_idx
 
 
-def load_reasonable_drugs(drug_annotation_dir):
-    reasonable_drugs_file = os.path.join(drug_annotation_dir, 'clinically_relevant_drugs.csv')
-    with open(reasonable_drugs_file, 'r') as f:
-        rdrugs = [row.strip() for row in f.readlines()]
-    return rdrugs
-
-
-
-
-def select_reasonable_drugs(other_drug_to_cids, rdrug_to_cids):
-    reasonable_cids = all_unique_values(rdrug_to_cids)
-    cid_to_other_drugs = defaultdict(set)
-    for other_drug, cids in other_drug_to_cids.items():
-        for cid in cids:
-            cid_to_other_drugs[cid].add(other_drug)
-    reasonable_other_drugs = set()
-    for cid, other_drugs in cid_to_other_drugs.items():
-        if cid in reasonable_cids:
-            reasonable_other_drugs.update(other_drugs)
-    return reasonable_other_drugs
-
-
 def subset_to_reasonable_drugs(ranked_drugs, drug2cids, drug_annotation_dir, annot=False, out_prefix=None, out_dir=None):
-    robfile = os.path.join(drug_annotation_dir, 'drug_source_moa_annotations.xlsx')
-    robdf = pd.read_excel(robfile, index_col=0, dtype=str)
-    reasonable_drugs = load_reasonable_drugs(drug_annotation_dir)
-
-    rdrug_to_cids = {}
-    hascid = robdf.cids.dropna()
-    for drug in hascid.index:
-        if drug in reasonable_drugs:
-            cids = robdf.loc[drug, 'cids'].split('|')
-            if cids != ['nan']:
-                rdrug_to_cids[drug] = list(map(int, cids))
-
-    reasonable_other_drugs = select_reasonable_drugs(drug2cids, rdrug_to_cids)
-
-    cid_to_rdrug = {}
-    for rdrug, cids in rdrug_to_cids.items():
-        for cid in cids:
-            cid_to_rdrug[cid] = rdrug
+    drug_index = load_drug_index(drug_annotation_dir)
+    reasonable_other_drugs = drug_index.reasonable_drugs(drug2cids)
 
     #print([d for d in reasonable_other_drugs if d not in ranked_drugs.columns])
-    reasonable_results = ranked_drugs.loc[:, reasonable_other_drugs].T
-
-    rdrug_mechs = pd.read_excel(robfile, index_col=0, sheetname='NCI +', dtype=str).iloc[:, 7].dropna()
-    rdrug_mechs.index = [str(idx).lower() for idx in rdrug_mechs.index]
-
-    rr_mechs = pd.Series(index=reasonable_results.index)
-    for drug in rr_mechs.index:
-        cids = drug2cids[drug]
-        for cid in cids:
-            if cid in cid_to_rdrug:
-                rdrug = cid_to_rdrug[cid]
-                if rdrug in rdrug_mechs:
-                    rr_mechs[drug] = rdrug_mechs.loc[rdrug]
-                else:
-                    rr_mechs[drug] = ''
+    reasonable_results = ranked_drugs.loc[:, list(reasonable_other_drugs)].T
+
+    rr_mechs = drug_index.annotate_moa(reasonable_results.index, drug2cids)
     if annot:
         reasonable_results['moa'] = rr_mechs
 
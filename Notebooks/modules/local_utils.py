@@ -1,11 +1,10 @@
-from functools import reduce
+from functools import reduce, lru_cache
 from collections import defaultdict, Counter
 import itertools
 
 import pandas as pd
 import numpy as np
 from pandas import ExcelWriter
-import networkx as nx
 from scipy.stats import rankdata
 from sklearn.preprocessing import scale
 
@@ -67,33 +66,98 @@ def standardize_idxs_and_dedup(exp, dr):
     return exp, dr
 
 
+class SynonymIndex(object):
+    """
+    Union-find over synonyms: labels like 'A /// B' join A and B, and every synonym maps to
+    the canonical label of its group, ' /// '.join(sorted(group)).
+    Use get_synonym_index() to reuse one index per vocabulary.
+    """
+
+    def __init__(self, labels=(), syn_delim=' /// '):
+        self.syn_delim = syn_delim
+        self.parent = {}
+        self.size = {}
+        self.canonical_labels = None
+        self.add_labels(labels)
+
+    def find(self, syn):
+        parent = self.parent
+        while parent[syn] != syn:
+            parent[syn] = parent[parent[syn]]  # path halving
+            syn = parent[syn]
+        return syn
+
+    def union(self, syn1, syn2):
+        root1, root2 = self.find(syn1), self.find(syn2)
+        if root1 == root2:
+            return
+        if self.size[root1] < self.size[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        self.size[root1] += self.size[root2]
+
+    def add_labels(self, labels):
+        for label in labels:
+            syns = label.split(self.syn_delim)
+            for syn in syns:
+                if syn not in self.parent:
+                    self.parent[syn] = syn
+                    self.size[syn] = 1
+            for syn in syns[1:]:
+                self.union(syns[0], syn)
+        self.canonical_labels = None
+
+    def canonical(self, label):
+        """
+        :param label: str, a synonym or ' /// '-joined synonyms already in the index
+        :return: str, canonical label of its group
+        """
+        if self.canonical_labels is None:
+            groups = defaultdict(list)
+            for syn in self.parent:
+                groups[self.find(syn)].append(syn)
+            self.canonical_labels = {}
+            for group in groups.values():
+                group_label = self.syn_delim.join(sorted(group))
+                for syn in group:
+                    self.canonical_labels[syn] = group_label
+        return self.canonical_labels[label.split(self.syn_delim)[0]]
+
+
+def get_synonym_index(labels, syn_delim=' /// '):
+    """
+    :return: SynonymIndex of labels; the indexes of the most recently used vocabularies are kept
+    """
+    return cached_synonym_index(frozenset(labels), syn_delim)
+
+
+@lru_cache(maxsize=8)
+def cached_synonym_index(labels, syn_delim):
+    return SynonymIndex(labels, syn_delim=syn_delim)
+
+
 def expand_cols_to_synonymns(dfs, syn_delim=' /// '):
-    dfcs = [df.copy() for df in dfs]
-    syn_graph = nx.Graph()
-    for df in dfcs:
-        for col in df.columns:
-            syns = col.split(syn_delim)
-            syn_graph.add_nodes_from(syns)
-            for s1, s2 in itertools.combinations(syns, 2):
-                syn_graph.add_edge(s1, s2)
-    syn2syns = {}
-    ccs = nx.connected_components(syn_graph)
-    for cc in ccs:
-        syn_string = syn_delim.join(sorted(cc))
-        for syn in cc:
-            syn2syns[syn] = syn_string
-    for i, df in enumerate(dfcs):
-        newcols = []
-        for col in df.columns:
-            syn1 = col.split(syn_delim)[0]
-            newcols.append(syn2syns[syn1])
-        df.columns = sorted(newcols)
-        dfcs[i] = merge_redundant_series(df, axis=1)
+    """
+    Relabel the columns of each DataFrame with the canonical label of its synonym group, across all dfs,
+    merging columns that become duplicates. Inputs are not modified; data is only copied where columns are merged.
+    """
+    syn_index = get_synonym_index(itertools.chain.from_iterable(df.columns for df in dfs), syn_delim=syn_delim)
+    dfcs = []
+    for df in dfs:
+        dfc = df.copy(deep=False)
+        dfc.columns = [syn_index.canonical(col) for col in df.columns]
+        if not dfc.columns.is_unique:
+            dfc = merge_redundant_series(dfc, axis=1)
+        dfcs.append(dfc)
     return dfcs
 
 
 def reduce_to_common_idxs(dfs, axis=1, syns=True):
-    dfcs = [df.T.copy() if axis == 0 else df.copy() for df in dfs]
+    """
+    Align DataFrames on the labels they have in common along axis, matching synonyms if syns.
+    :return: list of DataFrames with the same labels, in sorted order, along axis
+    """
+    dfcs = [df.T if axis == 0 else df for df in dfs]
     if syns:
         dfcs = expand_cols_to_synonymns(dfcs)
     idxs = [set(df.columns) for df in dfcs]
@@ -102,53 +166,106 @@ def reduce_to_common_idxs(dfs, axis=1, syns=True):
     return [df.T if axis == 0 else df for df in dfcs]
 
 
+merge_methods = ['mean', 'max', 'min', 'first', 'sum', 'median']
+
+
+def grouped_reduce(values, codes, method='mean', mask_nans=True):
+    """
+    Reduce the rows of values within each group, in one pass over the rows sorted by group.
+    :param values: float array, (n_rows, n_cols)
+    :param codes: int array, (n_rows,), group of each row, numbered 0 to n_groups - 1
+    :param method: one of merge_methods. 'first' takes the first row of each group, NaNs included.
+    :param mask_nans: if True, NaNs are ignored (all-NaN groups give NaN); if False, they propagate
+    :return: array, (n_groups, n_cols)
+    """
+    order = np.argsort(codes, kind='mergesort')
+    sorted_values = values[order]
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    if method == 'first':
+        return sorted_values[starts]
+    nans = np.isnan(sorted_values)
+    if method in ['mean', 'sum']:
+        if mask_nans:
+            sums = np.add.reduceat(np.where(nans, 0, sorted_values), starts, axis=0)
+            counts = np.add.reduceat((~nans).astype(int), starts, axis=0)
+        else:
+            sums = np.add.reduceat(sorted_values, starts, axis=0)
+            counts = np.diff(np.r_[starts, len(codes)])[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reduced = sums / counts if method == 'mean' else sums
+        reduced[np.broadcast_to(counts == 0, reduced.shape)] = np.nan
+    elif method in ['max', 'min']:
+        if method == 'max':
+            ufunc = np.fmax if mask_nans else np.maximum
+        else:
+            ufunc = np.fmin if mask_nans else np.minimum
+        reduced = ufunc.reduceat(sorted_values, starts, axis=0)
+    elif method == 'median':
+        reduced = pd.DataFrame(sorted_values).groupby(sorted_codes).median().values
+        if not mask_nans:
+            reduced[np.add.reduceat(nans.astype(int), starts, axis=0) > 0] = np.nan
+    else:
+        raise ValueError("{} not a supported method for merge".format(method))
+    return reduced
+
+
 def merge_redundant_series(orig_df, axis=0, method='mean', mask_nans=True):
+    """
+    Merge rows (axis=0) or columns (axis=1) that share a label, reducing them with method.
+    Merged labels keep the position of their first occurrence.
+    :param method: one of merge_methods
+    :param mask_nans: whether to ignore NaNs when merging
+    """
+    if method not in merge_methods:
+        raise ValueError("{} not a supported method for merge".format(method))
     df = orig_df.T if axis == 1 else orig_df
-    idx_counts = Counter(df.index)
-    already_single = []
-    mult_idxs = []
-    for idx, count in idx_counts.items():
-        (already_single if count == 1 else mult_idxs).append(idx)
-    single_subdf = df.loc[already_single]
-    if len(mult_idxs) == 0:
-        new_df = single_subdf
+    if df.index.is_unique:
+        new_df = df.copy()
     else:
+        codes, uniques = pd.factorize(df.index)
+        merged = grouped_reduce(df.values.astype(float), codes, method=method, mask_nans=mask_nans)
+        new_df = pd.DataFrame(merged, index=uniques, columns=df.columns)
+    return new_df.T if axis == 1 else new_df
 
-        series_list = []
-        for uid in mult_idxs:
-            subdf = df.loc[uid]
-            if isinstance(subdf, pd.DataFrame):
-                if mask_nans:
-                    mask = np.isnan(subdf)
-                    vals = np.ma.masked_array(subdf, mask)
-                else:
-                    vals = subdf.values
-                if method == 'mean':
-                    series = vals.mean(axis=0)
-                elif method == 'max':
-                    series = vals.max(axis=0)
-                elif method == 'min':
-                    series = vals.min(axis=0)
-                elif method == 'first':
-                    series = vals[0]
-                elif method == 'sum':
-                    series = vals.sum(axis=0)
-                else:
-                    raise ValueError("{} not a supported method for merge".format(method))
-                series = pd.Series(series, index=subdf.columns)
-                series.name = uid
-            else:
-                series = subdf
-            series_list.append(series)
 
-        dedup_df = pd.concat(series_list, axis=1).T
-        # print(single_subdf.shape, dedup_df.shape)
-        new_df = pd.concat([dedup_df, single_subdf], axis=0)
-    return new_df.T if axis == 1 else new_df
+def gct_dtypes(gct_path):
+    """
+    :return: dict of column name to dtype for pd.read_csv: str for Name and Description, float for the samples
+    """
+    with open(gct_path, 'r') as f:
+        f.readline()
+        f.readline()
+        cols = f.readline().rstrip('\n').split('\t')
+    dtypes = {col: float for col in cols[2:]}
+    dtypes.update({cols[0]: str, cols[1]: str})
+    return dtypes
+
+
+def iter_gct(gct_path, chunksize=1000, use_description=False, description_func=lambda x: x):
+    """
+    Stream a GCT file in blocks of rows, without reading the whole matrix.
+    :param chunksize: int, number of rows (features) per block
+    :return: iterator of Pandas DataFrames, (chunksize, n_samples), features as index, Description dropped
+        (or used as index, if use_description)
+    """
+    dtypes = gct_dtypes(gct_path)
+    for chunk in pd.read_csv(gct_path, sep='\t', skiprows=2, index_col=0, dtype=dtypes, chunksize=chunksize):
+        dcol = chunk.columns[0]
+        if use_description:
+            chunk.index = [description_func(d) for d in chunk[dcol]]
+        yield chunk.drop(dcol, axis=1)
 
 
-def read_gct(gct_path, use_description=False, description_func=lambda x: x, transpose=True, dropna_axes=[]):
-    df = pd.read_table(gct_path, skiprows=2, index_col=0)
+def read_gct(gct_path, use_description=False, description_func=lambda x: x, transpose=True, dropna_axes=[],
+             chunksize=10000):
+    """
+    Reads the whole matrix into memory; use iter_gct() to stream a file in blocks of rows.
+    :param chunksize: int, number of rows parsed at a time, with explicit dtypes (str names, float values).
+        The blocks are concatenated, so this does not bound peak memory.
+    """
+    dtypes = gct_dtypes(gct_path)
+    df = pd.concat(pd.read_csv(gct_path, sep='\t', skiprows=2, index_col=0, dtype=dtypes, chunksize=chunksize))
     for axis in dropna_axes:
         df = df.dropna(axis=axis)
     if 'description' in df.columns:
@@ -164,7 +281,12 @@ def read_gct(gct_path, use_description=False, description_func=lambda x: x, tran
     return df
 
 
-def write_gct(tdf, path):
+def write_gct(tdf, path, chunksize=1000, float_format=None):
+    """
+    :param tdf: Pandas DataFrame, (n_samples, n_features); written transposed, one feature per row
+    :param chunksize: int, number of rows formatted and written at a time
+    :param float_format: str, optional, e.g. '%.6g'; about 3x faster than the default, which writes values as str()
+    """
     df = tdf.T
     n_rows, n_cols = df.shape
     with open(path, 'w') as f:
@@ -172,27 +294,65 @@ def write_gct(tdf, path):
         f.write("{}\t{}\n".format(n_rows, n_cols))
         header_row = 'Name\tDescription\t' + '\t'.join(df.columns) + '\n'
         f.write(header_row)
-        for i in range(n_rows):
-            name = df.index[i]
-            values = df.iloc[i]
-            row = '{}\t{}\t{}\n'.format(name, name, '\t'.join(map(str, values)))
-            f.write(row)
+        if float_format is not None:
+            row_format = '\t'.join([float_format] * n_cols)
+        # built once: for mixed dtypes, each df.values call builds a new array of the whole frame
+        values = df.values
+        for start in range(0, n_rows, chunksize):
+            names = df.index[start:start + chunksize]
+            chunk = values[start:start + chunksize].tolist()
+            if float_format is None:
+                rows = ['\t'.join(map(str, row)) for row in chunk]
+            else:
+                rows = [row_format % tuple(row) for row in chunk]
+            f.write(''.join(['{}\t{}\t{}\n'.format(name, name, row) for name, row in zip(names, rows)]))
 
 
 def all_unique_values(set_dict):
     return set(itertools.chain.from_iterable(set_dict.values()))
 
 
+def rank_rows(s, method='dense'):
+    """
+    Same as np.array([rankdata(s[i], method=method) for i in range(n)]), with one argsort for all rows.
+    NaNs are ranked last, each as its own value.
+    :param s: array, (n, m)
+    :param method: 'dense', 'ordinal', 'min', 'max' or 'average', as in scipy.stats.rankdata
+    :return: array, (n, m), ranks starting at 1
+    """
+    n, m = s.shape
+    # only 'ordinal' depends on the order within ties, which must then be stable as in rankdata
+    order = np.argsort(s, axis=1, kind='mergesort' if method == 'ordinal' else 'quicksort')
+    sorted_s = np.take_along_axis(s, order, axis=1)
+    positions = np.broadcast_to(np.arange(m), (n, m))
+    starts_tie_group = np.ones((n, m), dtype=bool)
+    starts_tie_group[:, 1:] = sorted_s[:, 1:] != sorted_s[:, :-1]
+    if method == 'ordinal':
+        sorted_ranks = positions + 1
+    elif method == 'dense':
+        sorted_ranks = np.cumsum(starts_tie_group, axis=1)
+    elif method in ['min', 'max', 'average']:
+        ends_tie_group = np.ones((n, m), dtype=bool)
+        ends_tie_group[:, :-1] = starts_tie_group[:, 1:]
+        mins = np.maximum.accumulate(np.where(starts_tie_group, positions, 0), axis=1) + 1
+        maxs = np.minimum.accumulate(np.where(ends_tie_group, positions, m)[:, ::-1], axis=1)[:, ::-1] + 1
+        sorted_ranks = {'min': mins, 'max': maxs, 'average': (mins + maxs) / 2}[method]
+    else:
+        raise ValueError("{} not a supported ranking method".format(method))
+    ranks = np.empty((n, m), dtype=sorted_ranks.dtype)
+    np.put_along_axis(ranks, order, sorted_ranks, axis=1)
+    return ranks
+
+
 def rank_normalize(x_orig, ascending=True, method='dense', norm_to_max=True, add_jitter=False,
                    jitter_scale=1E-9):  # , ties=False
-    # Todo: profile two methods, see if rankdata is slower, if so efficiently check for ties within each row
     x = x_orig.copy()
     if add_jitter:
         jitter = jitter_scale * np.random.uniform(size=x.shape)
         x += jitter
     n, m = x.shape
     s = x.values if isinstance(x, pd.DataFrame) else x
-    ranks = np.array([rankdata(s[i], method=method) for i in range(n)]) - 1
+    ranks = rank_rows(np.asarray(s, dtype=float), method=method) - 1
     if not ascending:
         ranks = (m - ranks) - 1
     if norm_to_max:
@@ -213,13 +373,12 @@ def quantile_normalize(x):
     """
     n, m = x.shape
     s = x.values if isinstance(x, pd.DataFrame) else x
-    ranks = np.array([rankdata(s[i], method='dense') for i in range(n)]) - 1
+    s = np.asarray(s, dtype=float)
+    ranks = rank_rows(s, method='dense') - 1
     sorted_s = np.sort(s, axis=1)
     col_means = np.mean(sorted_s, axis=0)
-    ranks_copy = ranks.copy().astype(float)
-    for rank in range(ranks.shape[1]):
-        ranks_copy[ranks == rank] = col_means[rank]
-    return pd.DataFrame(ranks_copy, index=x.index, columns=x.columns) if isinstance(x, pd.DataFrame) else ranks_copy
+    normalized = col_means[ranks]  # tied values share the mean of their dense rank
+    return pd.DataFrame(normalized, index=x.index, columns=x.columns) if isinstance(x, pd.DataFrame) else normalized
 
 
 def scale_df(df):
@@ -0,0 +1,141 @@
+"""
+Per-sample results kept on disk with a hash of the inputs that produced them,
+so that re-running a pipeline only recomputes samples that are new or whose inputs changed.
+"""
+import os
+import hashlib
+import json
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def hash_inputs(*inputs):
+    """
+    :param inputs: Pandas DataFrames/Series, NumPy arrays, or anything with a stable repr() (str, float, dict, ...)
+    :return: str, SHA-1 hex digest over all inputs, in order
+    """
+    sha1 = hashlib.sha1()
+    for item in inputs:
+        if isinstance(item, (pd.DataFrame, pd.Series)):
+            labels = [item.index.tolist()] + ([item.columns.tolist()] if isinstance(item, pd.DataFrame) else [])
+            sha1.update(json.dumps(labels, default=str).encode())
+            sha1.update(np.ascontiguousarray(item.values, dtype=float).tobytes())
+        elif isinstance(item, np.ndarray):
+            sha1.update(np.ascontiguousarray(item, dtype=float).tobytes())
+        else:
+            sha1.update(repr(item).encode())
+        sha1.update(b'\0')
+    return sha1.hexdigest()
+
+
+def file_sha1(path, block_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def same_source(cached_source, source, path):
+    """
+    :param cached_source: dict with the 'size', 'mtime' and 'sha1' of path when a cache was built from it
+    :param source: dict with the current 'size' and 'mtime' of path
+    :return: bool, whether path is unchanged; only hashed if touched since
+    """
+    if cached_source['size'] != source['size']:
+        return False
+    if cached_source['mtime'] == source['mtime']:
+        return True
+    return cached_source.get('sha1') == file_sha1(path)
+
+
+def file_sources(paths):
+    """
+    :return: list of dicts with the absolute 'path', 'size' and 'mtime' of each file, for same_sources()
+    """
+    sources = []
+    for path in paths:
+        stat = os.stat(path)
+        sources.append({'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime})
+    return sources
+
+
+def same_sources(cached_sources, sources):
+    """
+    same_source() for each of a list of files, which must also be the same files in the same order
+    """
+    return [s['path'] for s in cached_sources] == [s['path'] for s in sources] and \
+        all(same_source(cached, source, source['path']) for cached, source in zip(cached_sources, sources))
+
+
+def replace_file(path, write):
+    """
+    Call write(temp_path) on a new file in the directory of path, then move it onto path, so that an
+    interrupted write leaves path intact and concurrent writers never leave it half-written.
+    """
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def write_json(obj, path):
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+
+
+class ResultsStore(object):
+    """
+    One pickle per sample in results_dir, plus index.json recording the input hash of each.
+    Pickles keep dtypes and full float precision, so stored results equal freshly computed ones.
+
+    Parameters
+    ----------
+    results_dir : str
+        Created if it does not exist.
+    suffix : str
+        Appended to sample names in file names, e.g. 'discover' gives MB002.discover.pkl
+    """
+
+    def __init__(self, results_dir, suffix='results'):
+        self.results_dir = results_dir
+        self.suffix = suffix
+        if not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+        self.index_file = os.path.join(results_dir, 'index.{}.json'.format(suffix))
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def results_file(self, sample):
+        return os.path.join(self.results_dir, '{}.{}.pkl'.format(sample, self.suffix))
+
+    def is_valid(self, sample, input_hash):
+        return self.index.get(str(sample)) == input_hash and os.path.exists(self.results_file(sample))
+
+    def stale_samples(self, sample_hashes):
+        """
+        :param sample_hashes: dict of sample name to input hash
+        :return: list of samples without results for these inputs
+        """
+        return [sample for sample, input_hash in sample_hashes.items() if not self.is_valid(sample, input_hash)]
+
+    def get(self, sample):
+        return pd.read_pickle(self.results_file(sample))
+
+    def put(self, sample, input_hash, results):
+        """
+        The results are on disk before the index records input_hash for them.
+        :param results: Pandas DataFrame, e.g. one row of discover() output
+        """
+        replace_file(self.results_file(sample), results.to_pickle)
+        self.index[str(sample)] = input_hash
+        replace_file(self.index_file, lambda path: write_json(self.index, path))